@@ -1,68 +1,758 @@
-import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import hashlib
+from datetime import date, datetime
+from functools import wraps
+from flask import Flask, Blueprint, Response, current_app, request, abort, \
+    jsonify, make_response, stream_with_context
+from flask.json import JSONEncoder
 from flask_cors import CORS
-from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.routing import IntegerConverter
+
+
+from database.models import db, setup_db, insert_many, update_many, \
+    delete_many, update_by_id, delete_by_id, assign_cast, unassign_cast, \
+    versions, row_version, pool_stats, insert_statements, write_statements, \
+    Movies, Actors
+from database.cache import setup_cache, current_cache
+from database.idempotency import claim, finish, release, \
+    KeyReused, KeyInProgress
+from database.queries import paginate, stream, list_query, parse_fields, \
+    parse_include, select_fields, to_dicts, positive_int, page_size, \
+    is_int, INT_MAX
+from database.search import search
+from database.profiler import setup_profiler, query_budget
+from serializer import setup_serializer, current_serializer
+from metrics import setup_metrics, timed, render as render_metrics
+from database.stats import movie_stats, actor_stats
+from auth.auth import requires_auth, has_permission, setup_auth, AuthError
+from settings import load_settings
+
+
+class APIJSONEncoder(JSONEncoder):
+    # dates are sent as ISO 8601 (2019-10-25) instead of Flask's HTTP date
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+class IdConverter(IntegerConverter):
+    # /movies/<id:movie_id> only matches the ids an Integer column can
+    # hold, a longer one is a 404 instead of an overflow in the driver
+    def __init__(self, map):
+        super().__init__(map, max=INT_MAX)
+
+
+api = Blueprint('api', __name__)
+
+'''
+create_app(config=None)
+    the application factory, a Flask app serving the routes of api with
+    the auth settings, the database, the metrics and the SQL profiler
+    set up
+
+    config is a dict, or an object whose uppercase attributes are read,
+    of Flask settings plus
+        DATABASE_URL: the primary database, $DATABASE_URL by default
+        DATABASE_REPLICA_URLS: a list of read replica URLs,
+            $DATABASE_REPLICA_URLS by default
+        DB_POOL: pool settings overriding the DB_* environment
+            variables, e.g. {'pool_size': 2}, see database/models.py
+        AUTH0_DOMAIN, API_AUDIENCE, AUTH_KEYS and the other
+            AUTH_SETTINGS, the environment variables of the same name by
+            default, see auth/auth.py
+        SECRET_KEY, DATABASE_REPLICA_POLICY and
+            DATABASE_REPLICA_STICKY_SECONDS, likewise
+
+    importing this module configures nothing and the engines connect on
+    the first query; APP, the app of `gunicorn app:APP`, manage.py and
+    the tests, is created from the environment on first access
+'''
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.json_encoder = APIJSONEncoder
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
+    load_settings(app.config)
+    CORS(app)
 
+    setup_auth(app)
+    setup_db(app, app.config.get('DATABASE_URL'),
+             app.config.get('DB_POOL'),
+             app.config.get('DATABASE_REPLICA_URLS'))
+    setup_cache(app)
+    setup_serializer(app)
+    setup_metrics(app)
+    setup_profiler(app)
+    app.url_map.converters['id'] = IdConverter
+    app.register_blueprint(api)
+    return app
 
-from database.models import setup_db, Movies, Actors
-from auth.auth import requires_auth, AuthError
 
+def __getattr__(name):
+    global APP
+    if name == 'APP':
+        APP = create_app()
+        return APP
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-def create_app(test_config=None):
-    # create and configure the app
-    app = Flask(__name__)
-    CORS(app)
 
-    return app
+'''
+Streaming listings
+    GET /movies and GET /actors send the whole table as NDJSON (one JSON
+    object per line) when asked with `?stream=1` or
+    `Accept: application/x-ndjson`; rows are fetched, serialized and
+    flushed one batch at a time so memory stays flat
+'''
+
+NDJSON = 'application/x-ndjson'
+
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == NDJSON
+
+
+def ndjson_response(query, model, fields, sort, include):
+    serializer = current_serializer()
+
+    def generate():
+        for batch in stream(query, model, sort):
+            if include:
+                yield b''.join(
+                    serializer.dumps(item) + b'\n'
+                    for item in to_dicts(model, fields, batch, include))
+            else:
+                yield serializer.lines(fields, batch)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+'''
+JSON responses
+    the read endpoints answer through json_response(), compact JSON from
+    serializer.py instead of jsonify(); a page of rows without
+    `?include=` is encoded straight from the row tuples (encode_items)
+'''
+
+
+def json_response(payload, status=200):
+    with timed('serialize'):
+        body = current_serializer().payload(payload)
+    return Response(body, status, mimetype='application/json')
+
+
+def encode_items(model, fields, rows, include):
+    with timed('serialize'):
+        if include:
+            return to_dicts(model, fields, rows, include)
+        return current_serializer().rows(fields, rows)
+
+
+'''
+cached(model, related=())
+    conditional GET and response caching for a GET endpoint, goes under
+    @requires_auth
+
+    the version state of the response is the version of model's table
+    (list endpoints) or the updated_at of the row (item endpoints, the
+    view gets the row id as its only keyword argument), plus the
+    versions of the related tables when the request has `?include=`;
+    reading it is a primary key lookup, see table_versions in
+    database/models.py
+
+    the ETag is a hash of the path, the query parameters, the caller's
+    permissions and the version state, Last-Modified is the newest
+    timestamp in the state
+        - a request with a matching If-None-Match (or, without one, an
+          If-Modified-Since that is not older than Last-Modified) gets a
+          304 without running the view
+        - otherwise the ETag is the response cache key (database/cache.py)
+
+    streamed responses are neither cached nor validated
+'''
+
+
+def version_state(model, related, kwargs):
+    tables = related if request.args.get('include') else ()
+    if not kwargs:
+        return versions((model.__tablename__,) + tables)
+
+    updated_at = row_version(model, *kwargs.values())
+    if updated_at is None:
+        return None
+    return [(model.__tablename__, updated_at)] + \
+        (versions(tables) if tables else [])
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified is not None \
+        and last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+
+
+def cached(model, related=()):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if wants_stream():
+                return f(payload, *args, **kwargs)
+
+            state = version_state(model, related, kwargs)
+            if state is None:
+                # no such row, the view answers with its 404
+                return f(payload, *args, **kwargs)
+
+            response_cache = current_cache()
+            etag = response_cache.key(
+                request.path, request.args.items(multi=True),
+                sorted(payload.get('permissions', [])), state)
+            last_modified = max((row[-1] for row in state if row[-1]),
+                                default=None)
+
+            if not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                hit = response_cache.get(etag) \
+                    if response_cache.enabled else None
+                if hit is not None:
+                    body, status, mimetype = hit
+                    response = Response(body, status, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    response = make_response(f(payload, *args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if response_cache.enabled:
+                        response_cache.set(
+                            etag, response.get_data(),
+                            response.status_code, response.mimetype)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return cached_decorator
+
+
+'''
+idempotent
+    Idempotency-Key support for a create endpoint, goes under
+    @requires_auth; a request with the header runs once per caller
+    (the token subject) and key, see database/idempotency.py
+        - a retry gets the first response back, with an
+          Idempotent-Replayed: true header
+        - a retry while the first request is still running waits for
+          it, 409 if it takes too long
+        - the same key with another body is a 422
+    requests that fail (an error or a 5xx) leave nothing behind and can
+    be retried with the same key
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > 255:
+            abort(400)
+
+        caller = payload.get('sub', '')
+        request_hash = hashlib.sha256(
+            request.path.encode() + b'\n' + request.get_data()).hexdigest()
+        try:
+            stored = claim(caller, key, request_hash)
+        except KeyReused:
+            abort(422)
+        except KeyInProgress:
+            abort(409)
+
+        if stored is not None:
+            status, mimetype, body = stored
+            response = Response(body, status, mimetype=mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            release(caller, key)
+            raise
+        if response.status_code >= 500:
+            release(caller, key)
+        else:
+            finish(caller, key, response.status_code, response.mimetype,
+                   response.get_data())
+        return response
+
+    return wrapper
+
+
+'''
+parse_release_date(value)
+    release dates are sent as DD-MM-YYYY (25-10-2019) or as ISO 8601
+    (2019-10-25), raises ValueError for anything else
+'''
+
+DATE_FORMATS = ('%d-%m-%Y', '%Y-%m-%d')
+
+
+def parse_release_date(value):
+    if not isinstance(value, str):
+        raise ValueError('release_date must be a string')
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f'invalid release_date {value}')
+
+
+'''
+Bulk create
+    POST /movies/bulk and POST /actors/bulk take an array of objects, at
+    most BULK_MAX_ITEMS; every item is validated first, the valid ones
+    are inserted in a single transaction and the others are reported
+    back by their index in the array
+
+    POST /movies and POST /actors validate the fields their object has
+    with the same MOVIE_FIELDS and ACTOR_FIELDS, an invalid one is a
+    400; the fields left out stay optional there and are stored NULL
+'''
+
+
+def bulk_max_items():
+    return current_app.config['BULK_MAX_ITEMS']
+
+
+def text(name, value):
+    if value is None:
+        raise ValueError(f'{name} is required')
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'{name} must be a non-empty string')
+    return value
+
+
+def age(name, value):
+    if not is_int(value) or value < 0:
+        raise ValueError(f'{name} must be a positive integer')
+    return value
+
+
+def release_date(name, value):
+    if value is None:
+        raise ValueError(f'{name} is required')
+    return parse_release_date(value)
+
+
+MOVIE_FIELDS = {'title': text, 'release_date': release_date}
+ACTOR_FIELDS = {'name': text, 'age': age, 'gender': text}
+
+
+def validate(fields, item, partial=False):
+    """Returns the column values of item, raises ValueError if invalid
+    With partial only the fields present in item are validated.
+    """
+    if not isinstance(item, dict):
+        raise ValueError('expected an object')
+
+    if not partial:
+        names = fields
+    else:
+        unknown = sorted(set(item) - set(fields))
+        if unknown:
+            raise ValueError(f'unknown field {unknown[0]}')
+        names = [name for name in fields if name in item]
+        if not names:
+            raise ValueError('no changes')
+
+    return {name: fields[name](name, item.get(name)) for name in names}
+
+
+def present(fields, item):
+    """Returns the column values of item, raises ValueError if invalid
+    The fields item leaves out or sets to null are None.
+    """
+    if not isinstance(item, dict) or not item:
+        raise ValueError('expected an object')
+
+    return {name: None if item.get(name) is None
+            else fields[name](name, item[name]) for name in fields}
+
+
+def bulk_ids(ids):
+    if not isinstance(ids, list) or not ids or len(ids) > bulk_max_items() \
+            or not all(is_int(item_id) for item_id in ids):
+        abort(400)
+    return list(dict.fromkeys(ids))
+
 
+def bulk_create(model, fields):
+    items = request.get_json()
+    if not isinstance(items, list) or not items \
+            or len(items) > bulk_max_items():
+        abort(400)
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate(fields, item))
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+
+    created = insert_many(model, rows) if rows else []
+
+    return jsonify({
+        'success': True,
+        'created': created,
+        'errors': errors
+    })
+
+
+'''
+Batch update and delete
+    PATCH /movies/bulk and PATCH /actors/bulk take either
+    {"ids": [...], "changes": {...}} or a list of {"id", "changes"}
+    objects; items with the same changes are grouped into one
+    `UPDATE ... WHERE id IN (...)`
+
+    DELETE /movies/bulk and DELETE /actors/bulk take {"ids": [...]}
+
+    the responses list the ids that matched a row and the ones that
+    didn't
+'''
 
-APP = create_app()
-db = setup_db(APP)
-migrate = Migrate(APP, db)
 
+def bulk_update(model, fields):
+    body = request.get_json()
+    errors = []
+
+    if isinstance(body, dict):
+        ids = bulk_ids(body.get('ids'))
+        try:
+            updates = [(ids, validate(fields, body.get('changes'),
+                                      partial=True))]
+        except ValueError:
+            abort(400)
+
+    elif isinstance(body, list) and body and len(body) <= bulk_max_items():
+        groups = {}
+        seen = set()
+        for index, item in enumerate(body):
+            try:
+                if not isinstance(item, dict) or not is_int(item.get('id')):
+                    raise ValueError('id is required')
+                if item['id'] in seen:
+                    raise ValueError('duplicate id')
+                values = validate(fields, item.get('changes'), partial=True)
+            except ValueError as error:
+                errors.append({'index': index, 'message': str(error)})
+                continue
+
+            seen.add(item['id'])
+            key = tuple(sorted(values.items()))
+            groups.setdefault(key, []).append(item['id'])
+        updates = [(ids, dict(key)) for key, ids in groups.items()]
+
+    else:
+        abort(400)
+
+    requested = [item_id for ids, values in updates for item_id in ids]
+    updated = set(update_many(model, updates)) if updates else set()
+
+    return jsonify({
+        'success': True,
+        'updated': sorted(updated),
+        'not_found': sorted(set(requested) - updated),
+        'errors': errors
+    })
+
+
+def bulk_delete(model):
+    body = request.get_json()
+    ids = bulk_ids(body.get('ids') if isinstance(body, dict) else body)
+
+    deleted = set(delete_many(model, ids))
 
-@APP.route('/')
+    return jsonify({
+        'success': True,
+        'deleted': sorted(deleted),
+        'not_found': sorted(set(ids) - deleted)
+    })
+
+
+'''
+Query budgets
+    @query_budget(n) is the most SQL statements a request to the endpoint
+    runs on its costliest path (a cache miss, `?include=`, an
+    Idempotency-Key taken over from a dead worker, with a sweep),
+    checked with QUERY_BUDGETS, see
+    database/profiler.py
+
+    the bulk endpoints run statements per chunk of their ids (and on
+    databases without RETURNING per row they insert), their budget is
+    worked out for the request: the statements insert_many,
+    update_many or delete_many run for its body (insert_statements and
+    write_statements), an update counted as if no two items had the
+    same changes, plus those of the endpoint around them
+'''
+
+
+def bulk_size():
+    """The number of items, or of ids, in the body of a bulk request"""
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('ids')
+    return len(body) if isinstance(body, list) else 0
+
+
+def bulk_create_budget():
+    return 6 + insert_statements(bulk_size())
+
+
+def bulk_update_budget():
+    if isinstance(request.get_json(silent=True), dict):
+        return 1 + write_statements([bulk_size()])
+    return 1 + write_statements([1] * bulk_size())
+
+
+def bulk_delete_budget():
+    return 1 + write_statements([bulk_size()])
+
+
+@api.route('/')
 def index():
     return 'Successful'
 
 
-@APP.route('/movies')
+'''
+GET /health
+    checks the database with a `SELECT 1` and reports the state of the
+    connection pool (database/models.py) and of the read replicas; no
+    permission needed, load balancers call it
+'''
+
+
+@api.route('/health')
+@query_budget(1)
+def health():
+    try:
+        db.session.execute('SELECT 1')
+        status = 200
+    except SQLAlchemyError:
+        db.session.rollback()
+        status = 503
+
+    return jsonify({
+        'success': status == 200,
+        'database': 'ok' if status == 200 else 'unavailable',
+        'pool': pool_stats(),
+        'replicas': db.router.stats()
+    }), status
+
+
+'''
+GET /metrics
+    request counts, latency, per-phase timings, SQL statement counts and
+    response sizes by route in the Prometheus text format, see metrics.py;
+    no permission needed, like /health
+'''
+
+
+@api.route('/metrics')
+def metrics():
+    return Response(render_metrics(current_app.config['METRICS_DIR']),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api.route('/movies')
+@query_budget(3)
 @requires_auth('get:movies')
+@cached(Movies, related=('movie_actors', 'actors'))
 def get_movies(payload):
-    movies = Movies.query.order_by(Movies.id).all()
-    movies_formatted = [movie.format() for movie in movies]
-    return jsonify({
+    try:
+        query, fields, sort = list_query(Movies, request.args)
+        include = parse_include(Movies, request.args.get('include'))
+        if wants_stream():
+            return ndjson_response(query, Movies, fields, sort, include)
+
+        movies, page = paginate(query, Movies, sort, request.args)
+    except ValueError:
+        abort(400)
+
+    return json_response({
         'success': True,
-        'movies': movies_formatted
+        'movies': encode_items(Movies, fields, movies, include),
+        **page
     })
 
 
-@APP.route('/actors')
+@api.route('/actors')
+@query_budget(3)
 @requires_auth('get:actors')
+@cached(Actors, related=('movie_actors', 'movies'))
 def get_actors(payload):
-    actors = Actors.query.order_by(Actors.id).all()
+    try:
+        query, fields, sort = list_query(Actors, request.args)
+        include = parse_include(Actors, request.args.get('include'))
+        if wants_stream():
+            return ndjson_response(query, Actors, fields, sort, include)
+
+        actors, page = paginate(query, Actors, sort, request.args)
+    except ValueError:
+        abort(400)
 
-    actors_formatted = [actor.format() for actor in actors]
-    return jsonify({
+    return json_response({
         'success': True,
-        'actors': actors_formatted
+        'actors': encode_items(Actors, fields, actors, include),
+        **page
     })
 
 
-@APP.route('/movies', methods=['POST'])
-@requires_auth('post:movies')
-def create_movie(payload):
+@api.route('/movies/<id:movie_id>')
+@query_budget(4)
+@requires_auth('get:movies')
+@cached(Movies, related=('movie_actors', 'actors'))
+def get_movie(payload, movie_id):
+    try:
+        fields = parse_fields(Movies, request.args.get('fields'))
+        include = parse_include(Movies, request.args.get('include'))
+    except ValueError:
+        abort(400)
 
-    body = request.get_json()
+    movie = select_fields(Movies, fields) \
+        .filter(Movies.id == movie_id).one_or_none()
+    if movie is None:
+        abort(404)
+
+    return json_response({
+        'success': True,
+        'movie': to_dicts(Movies, fields, [movie], include)[0]
+    })
+
+
+@api.route('/actors/<id:actor_id>')
+@query_budget(4)
+@requires_auth('get:actors')
+@cached(Actors, related=('movie_actors', 'movies'))
+def get_actor(payload, actor_id):
+    try:
+        fields = parse_fields(Actors, request.args.get('fields'))
+        include = parse_include(Actors, request.args.get('include'))
+    except ValueError:
+        abort(400)
 
-    if not body:
+    actor = select_fields(Actors, fields) \
+        .filter(Actors.id == actor_id).one_or_none()
+    if actor is None:
+        abort(404)
+
+    return json_response({
+        'success': True,
+        'actor': to_dicts(Actors, fields, [actor], include)[0]
+    })
+
+
+'''
+GET /stats/movies and GET /stats/actors
+    aggregates computed in the database, see database/stats.py; they
+    take the filters of GET /movies and GET /actors
+'''
+
+
+@api.route('/stats/movies')
+@query_budget(3)
+@requires_auth('get:movies')
+@cached(Movies)
+def get_movie_stats(payload):
+    try:
+        stats = movie_stats(request.args)
+    except ValueError:
+        abort(400)
+
+    return json_response({
+        'success': True,
+        **stats
+    })
+
+
+@api.route('/stats/actors')
+@query_budget(4)
+@requires_auth('get:actors')
+@cached(Actors)
+def get_actor_stats(payload):
+    try:
+        stats = actor_stats(request.args)
+    except ValueError:
+        abort(400)
+
+    return json_response({
+        'success': True,
+        **stats
+    })
+
+
+'''
+GET /search?q=
+    ranked search over movie titles and actor names, actors are only
+    searched for callers with get:actors; `type=movie` or `type=actor`
+    narrows it down, `limit` and `page` page through the results
+'''
+
+
+@api.route('/search')
+@query_budget(1)
+@requires_auth('get:movies')
+def search_catalog(payload):
+    kinds = [kind for kind in ('movie', 'actor')
+             if request.args.get('type', kind) == kind]
+    if not kinds:
+        abort(400)
+    if 'actor' in kinds and not has_permission('get:actors', payload):
+        if kinds == ['actor']:
+            abort(403)
+        kinds.remove('actor')
+
+    try:
+        limit = page_size(request.args)
+        page = positive_int(request.args, 'page', 1)
+        results = search(request.args.get('q'), kinds, limit + 1,
+                         (page - 1) * limit)
+    except ValueError:
         abort(400)
 
-    new_title = body.get('title', None)
-    new_release_date = body.get('release_date', None)
+    return json_response({
+        'success': True,
+        'results': results[:limit],
+        'page': page,
+        'next_page': page + 1 if len(results) > limit else None
+    })
+
+
+@api.route('/movies', methods=['POST'])
+@query_budget(7)
+@requires_auth('post:movies')
+@idempotent
+def create_movie(payload):
+
+    try:
+        values = present(MOVIE_FIELDS, request.get_json())
+    except ValueError:
+        abort(400)
 
-    movie = Movies(title=new_title, release_date=new_release_date)
+    movie = Movies(**values)
     movie.insert()
 
     return jsonify({
@@ -70,20 +760,18 @@ def create_movie(payload):
     })
 
 
-@APP.route('/actors', methods=['POST'])
+@api.route('/actors', methods=['POST'])
+@query_budget(7)
 @requires_auth('post:actors')
+@idempotent
 def create_actors(payload):
 
-    body = request.get_json()
-
-    if not body:
+    try:
+        values = present(ACTOR_FIELDS, request.get_json())
+    except ValueError:
         abort(400)
 
-    new_name = body.get('name', None)
-    new_age = body.get('age', None)
-    new_gender = body.get('gender', None)
-
-    actor = Actors(name=new_name, age=new_age, gender=new_gender)
+    actor = Actors(**values)
     actor.insert()
 
     return jsonify({
@@ -91,81 +779,173 @@ def create_actors(payload):
     })
 
 
-@APP.route('/movies/<int:movie_id>', methods=['PATCH'])
+@api.route('/movies/bulk', methods=['POST'])
+@query_budget(bulk_create_budget)
+@requires_auth('post:movies')
+@idempotent
+def create_movies_bulk(payload):
+    return bulk_create(Movies, MOVIE_FIELDS)
+
+
+@api.route('/actors/bulk', methods=['POST'])
+@query_budget(bulk_create_budget)
+@requires_auth('post:actors')
+@idempotent
+def create_actors_bulk(payload):
+    return bulk_create(Actors, ACTOR_FIELDS)
+
+
+@api.route('/movies/bulk', methods=['PATCH'])
+@query_budget(bulk_update_budget)
 @requires_auth('patch:movies')
-def update_movie_partially(payload, movie_id):
-    movie = Movies.query.filter(Movies.id == movie_id).one_or_none()
+def update_movies_bulk(payload):
+    return bulk_update(Movies, MOVIE_FIELDS)
 
-    body = request.get_json()
 
-    title_updated = body.get('title', None)
-    release_date_updated = body.get('release_date', None)
+@api.route('/actors/bulk', methods=['PATCH'])
+@query_budget(bulk_update_budget)
+@requires_auth('patch:actors')
+def update_actors_bulk(payload):
+    return bulk_update(Actors, ACTOR_FIELDS)
+
+
+'''
+Single item PATCH and DELETE
+    each is one UPDATE or DELETE statement by id, without loading the
+    row first; no matching row is a 404
 
-    if title_updated:
-        movie.title = title_updated
+    PATCH applies the fields of the body that are set, like before,
+    and 400s when none are or one is invalid
+'''
+
+
+def changes(fields, body):
+    if not isinstance(body, dict):
+        abort(400)
 
-    if release_date_updated:
-        movie.release_date = release_date_updated
+    try:
+        return validate(fields, {
+            name: body[name] for name in fields if body.get(name)
+        }, partial=True)
+    except ValueError:
+        abort(400)
+
+
+@api.route('/movies/<id:movie_id>', methods=['PATCH'])
+@query_budget(2)
+@requires_auth('patch:movies')
+def update_movie_partially(payload, movie_id):
+    values = changes(MOVIE_FIELDS, request.get_json())
 
-    movie.update()
+    if not update_by_id(Movies, movie_id, values):
+        abort(404)
 
     return jsonify({
         'success': True
     })
 
 
-@APP.route('/actors/<int:actor_id>', methods=['PATCH'])
+@api.route('/actors/<id:actor_id>', methods=['PATCH'])
+@query_budget(2)
 @requires_auth('patch:actors')
 def update_actor_partially(payload, actor_id):
-    actor = Actors.query.filter(Actors.id == actor_id).one_or_none()
+    values = changes(ACTOR_FIELDS, request.get_json())
 
+    if not update_by_id(Actors, actor_id, values):
+        abort(404)
+
+    return jsonify({
+        'success': True
+    })
+
+
+'''
+Cast
+    POST /movies/<movie_id>/actors adds actors to the cast of a movie,
+    DELETE /movies/<movie_id>/actors removes them; both take
+    {"actor_ids": [...]} and list the actor ids that changed and the
+    ones that were skipped (unknown, or already in / not in the cast)
+'''
+
+
+def cast_request(movie_id):
     body = request.get_json()
+    actor_ids = bulk_ids(body.get('actor_ids')
+                         if isinstance(body, dict) else None)
 
-    name_updated = body.get('name', None)
-    age_updated = body.get('age', None)
-    gender_updated = body.get('gender', None)
+    if select_fields(Movies, ('id',)) \
+            .filter(Movies.id == movie_id).one_or_none() is None:
+        abort(404)
+    return actor_ids
 
-    if name_updated:
-        actor.name = name_updated
 
-    if age_updated:
-        actor.age = age_updated
+@api.route('/movies/<id:movie_id>/actors', methods=['POST'])
+@query_budget(4)
+@requires_auth('patch:movies')
+def assign_movie_cast(payload, movie_id):
+    actor_ids = cast_request(movie_id)
+    assigned = set(assign_cast(movie_id, actor_ids))
+
+    return jsonify({
+        'success': True,
+        'assigned': sorted(assigned),
+        'skipped': sorted(set(actor_ids) - assigned)
+    })
 
-    if gender_updated:
-        actor.gender = gender_updated
 
-    actor.update()
+@api.route('/movies/<id:movie_id>/actors', methods=['DELETE'])
+@query_budget(4)
+@requires_auth('patch:movies')
+def unassign_movie_cast(payload, movie_id):
+    actor_ids = cast_request(movie_id)
+    unassigned = set(unassign_cast(movie_id, actor_ids))
 
     return jsonify({
-        'success': True
+        'success': True,
+        'unassigned': sorted(unassigned),
+        'skipped': sorted(set(actor_ids) - unassigned)
     })
 
 
-@APP.route('/movies/<int:movie_id>', methods=['DELETE'])
+@api.route('/movies/bulk', methods=['DELETE'])
+@query_budget(bulk_delete_budget)
 @requires_auth('delete:movies')
-def remove_movie(payload, movie_id):
-    movie = Movies.query.filter(Movies.id == movie_id).one_or_none()
+def remove_movies_bulk(payload):
+    return bulk_delete(Movies)
 
-    movie.delete()
+
+@api.route('/actors/bulk', methods=['DELETE'])
+@query_budget(bulk_delete_budget)
+@requires_auth('delete:actors')
+def remove_actors_bulk(payload):
+    return bulk_delete(Actors)
+
+
+@api.route('/movies/<id:movie_id>', methods=['DELETE'])
+@query_budget(2)
+@requires_auth('delete:movies')
+def remove_movie(payload, movie_id):
+    if not delete_by_id(Movies, movie_id):
+        abort(404)
 
     return jsonify({
         'success': True
     })
 
 
-@APP.route('/actors/<int:actor_id>', methods=['DELETE'])
+@api.route('/actors/<id:actor_id>', methods=['DELETE'])
+@query_budget(2)
 @requires_auth('delete:actors')
 def remove_actor(payload, actor_id):
-    actor = Actors.query.filter(Actors.id == actor_id).one_or_none()
-
-    actor.delete()
+    if not delete_by_id(Actors, actor_id):
+        abort(404)
 
     return jsonify({
         'success': True
     })
 
 
-@APP.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return jsonify({
         'success': False,
@@ -174,7 +954,25 @@ def bad_request(error):
     }), 400
 
 
-@APP.errorhandler(500)
+@api.app_errorhandler(409)
+def conflict(error):
+    return jsonify({
+        'success': False,
+        'error': 409,
+        'message': 'conflict'
+    }), 409
+
+
+@api.app_errorhandler(422)
+def unprocessable(error):
+    return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'unprocessable'
+    }), 422
+
+
+@api.app_errorhandler(500)
 def internal_server_error(error):
     return jsonify({
         'success': False,
@@ -183,7 +981,7 @@ def internal_server_error(error):
     }), 500
 
 
-@APP.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized_error(error):
     return jsonify({
         'success': False,
@@ -192,7 +990,7 @@ def unauthorized_error(error):
     }), 401
 
 
-@APP.errorhandler(403)
+@api.app_errorhandler(403)
 def forbidden(error):
     return jsonify({
         'success': False,
@@ -201,7 +999,7 @@ def forbidden(error):
     }), 403
 
 
-@APP.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return jsonify({
         'success': False,
@@ -210,7 +1008,7 @@ def not_found(error):
     }), 404
 
 
-@APP.errorhandler(AuthError)
+@api.app_errorhandler(AuthError)
 def auth_error(AuthError):
     return jsonify({
         'success': False,
@@ -220,4 +1018,4 @@ def auth_error(AuthError):
 
 
 if __name__ == '__main__':
-    APP.run()
+    create_app().run()
@@ -1,14 +1,189 @@
 import os
-import json
-from flask import request, _request_ctx_stack
+from flask import current_app, has_app_context, request, \
+    _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from jose import jwt, JWTError
+from jose.utils import base64url_decode
 
+from auth.cache import TokenCache
+from auth.jwks import JWKSKeyStore, JWKSUnavailable
+from auth.keys import LocalKeyPair
+from metrics import timed
+
+
+'''
+Auth settings
+    AUTH_SETTINGS are read from the app's config, and from the
+    environment when the config doesn't set them; setup_auth(app) (called
+    by create_app) keeps them in app.extensions['auth'], an Auth with the
+    key provider and the TokenCache of the app, so two apps can verify
+    tokens for different tenants or audiences
+
+    ALGORITHMS is a comma separated list (RS256 by default), the alg of
+    a token's header has to be one of them
+
+    with Auth0 keys (jwks) AUTH0_DOMAIN and API_AUDIENCE have to be set,
+    check_settings() raises ValueError otherwise; the local keys go
+    without them, their tokens are issued by LOCAL_DOMAIN for
+    LOCAL_AUDIENCE
+
+    outside of an app, `python manage.py mint_token` for instance, the
+    Auth of the environment alone is used
+'''
+
+AUTH_SETTINGS = ('AUTH0_DOMAIN', 'API_AUDIENCE', 'ALGORITHMS', 'AUTH_KEYS',
+                 'JWKS_URL', 'JWKS_CACHE_TTL', 'JWKS_MIN_REFRESH_INTERVAL',
+                 'TOKEN_CACHE_SIZE')
+LOCAL_DOMAIN = 'localhost'
+LOCAL_AUDIENCE = 'CastingAgencyIdentifier'
+
+'''
+Key providers
+    verify_decode_jwt takes the signing key of a token from the key
+    provider of the app, anything with a get_key(kid) method returning
+    the key as a jwk.Key, constructed once and kept, or None
+
+    AUTH_KEYS picks it
+        jwks (default): JWKSKeyStore (auth/jwks.py) over JWKS_URL, the
+            Auth0 tenant's JWKS unless set to another URL or a local
+            file (file:///path/jwks.json)
+        local: LocalKeyPair (auth/keys.py), a key pair generated in
+            memory for this process
+        local:/path/key.pem: the LocalKeyPair in that PEM file, created
+            if missing; every process using the file accepts the tokens
+            of the others, and `python manage.py mint_token` issues them
+
+    the provider is created on first use, use_key_provider() swaps it
+    (the tests use it with a LocalKeyPair); mint_token() signs a token
+    for a role or a list of permissions with the current one, when it
+    is a LocalKeyPair
+'''
+
+ROLES = {
+    'casting_assistant': ['get:movies', 'get:actors'],
+    'executive_producer': ['get:movies', 'get:actors', 'post:movies',
+                           'post:actors', 'patch:movies', 'patch:actors',
+                           'delete:movies', 'delete:actors']
+}
+
+
+def key_provider_from_env(environ=os.environ):
+    keys = environ.get('AUTH_KEYS', 'jwks')
+    if keys == 'local':
+        return LocalKeyPair()
+    if keys.startswith('local:'):
+        return LocalKeyPair.load(keys[len('local:'):])
+    if keys != 'jwks':
+        raise ValueError(f'unknown AUTH_KEYS {keys}')
+
+    return JWKSKeyStore(
+        environ.get('JWKS_URL', f'https://{environ.get("AUTH0_DOMAIN")}'
+                                '/.well-known/jwks.json'),
+        ttl=int(environ.get('JWKS_CACHE_TTL', 600)),
+        min_refresh_interval=int(
+            environ.get('JWKS_MIN_REFRESH_INTERVAL', 30)))
+
+
+def is_local(environ):
+    keys = environ.get('AUTH_KEYS', 'jwks')
+    return keys == 'local' or keys.startswith('local:')
+
+
+def check_settings(environ=os.environ):
+    if is_local(environ):
+        return
+    missing = [name for name in ('AUTH0_DOMAIN', 'API_AUDIENCE')
+               if not environ.get(name)]
+    if missing:
+        raise ValueError(f'{" and ".join(missing)} must be set, or '
+                         f'AUTH_KEYS=local for tokens signed locally')
+
+
+def auth_settings(config, environ=os.environ):
+    """The AUTH_SETTINGS set in config, or else in environ"""
+    settings = {}
+    for name in AUTH_SETTINGS:
+        value = config.get(name)
+        if value is None:
+            value = environ.get(name)
+        if value is not None:
+            settings[name] = value
+    return settings
+
+
+class Auth:
+    def __init__(self, settings):
+        check_settings(settings)
+        self.settings = settings
+        self.domain = settings.get('AUTH0_DOMAIN') or LOCAL_DOMAIN
+        self.audience = settings.get('API_AUDIENCE') or LOCAL_AUDIENCE
+        self.issuer = 'https://' + self.domain + '/'
+        algorithms = settings.get('ALGORITHMS', 'RS256')
+        if isinstance(algorithms, str):
+            algorithms = algorithms.split(',')
+        self.algorithms = [name.strip() for name in algorithms
+                           if name.strip()]
+        self.token_cache = TokenCache(
+            int(settings.get('TOKEN_CACHE_SIZE', 1024)))
+        self.key_provider = None
+
+    def current_key_provider(self):
+        """The key provider, created from the settings on first use"""
+        if self.key_provider is None:
+            self.key_provider = key_provider_from_env(self.settings)
+        return self.key_provider
+
+    def use_key_provider(self, provider):
+        self.key_provider = provider
+        self.token_cache.clear()
+
+
+def setup_auth(app):
+    """Checks the auth settings of app and keeps them for its requests,
+    raises ValueError when the Auth0 ones are missing
+    """
+    app.extensions['auth'] = Auth(auth_settings(app.config))
+
+
+environ_auth = None
+
+
+def current_auth():
+    """The Auth of the current app, or of the environment outside one"""
+    global environ_auth
+    if has_app_context() and 'auth' in current_app.extensions:
+        return current_app.extensions['auth']
+    if environ_auth is None:
+        environ_auth = Auth(auth_settings({}))
+    return environ_auth
+
+
+def current_key_provider():
+    return current_auth().current_key_provider()
+
+
+def use_key_provider(provider, app=None):
+    """Verifies the tokens of app, the current one by default, with the
+    keys of provider from now on
+    """
+    auth = app.extensions['auth'] if app is not None else current_auth()
+    auth.use_key_provider(provider)
+
+
+def mint_token(role=None, permissions=None, subject='local|user',
+               expires_in=3600, **claims):
+    """A token for role (a key of ROLES) or for permissions, signed by
+    the LocalKeyPair in use
+    """
+    auth = current_auth()
+    keys = auth.current_key_provider()
+    if not isinstance(keys, LocalKeyPair):
+        raise ValueError('tokens can only be minted with AUTH_KEYS=local')
+    if permissions is None:
+        permissions = ROLES[role]
+    return keys.mint(auth.issuer, auth.audience,
+                     permissions, subject, expires_in, **claims)
 
-auth0_domain = os.environ['AUTH0_DOMAIN']
-algorithms = os.environ['ALGORITHMS']
-api_audience = os.environ['API_AUDIENCE']
 
 # AuthError Exception
 '''
@@ -75,45 +250,74 @@ def get_token_auth_header():
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        with the settings of the current app, see Auth settings above;
+        the keys come from its key provider, see Key providers above;
+        the signature is checked with the provider's jwk.Key
+        (verify_signature) and jwt.decode only validates the claims, so
+        the key isn't parsed again for every token
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
+        verified payloads are kept in the token_cache of the app until
+        the token expires, a token seen before is returned from there
+        without decoding it
 
     !!NOTE urlopen has a common certificate error described here:
     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 
 
+def verify_signature(token, key, header, algorithms):
+    if header.get('alg') not in algorithms:
+        raise JWTError('The specified alg value is not allowed')
+
+    signing_input, _, signature = token.rpartition('.')
+    if not key.verify(signing_input.encode(),
+                      base64url_decode(signature.encode())):
+        raise JWTError('Signature verification failed.')
+
+
 def verify_decode_jwt(token):
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    auth = current_auth()
+    payload = auth.token_cache.get(token)
+    if payload is not None:
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    jsonurl = urlopen(f'https://{auth0_domain}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    with timed('jwks'):
+        try:
+            rsa_key = auth.current_key_provider().get_key(
+                unverified_header['kid'])
+        except JWKSUnavailable:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 401)
+    if rsa_key is not None:
         try:
+            verify_signature(token, rsa_key, unverified_header,
+                             auth.algorithms)
             payload = jwt.decode(
                 token,
-                rsa_key,
-                algorithms=algorithms,
-                audience=api_audience,
-                issuer='https://' + auth0_domain + '/'
+                None,
+                algorithms=auth.algorithms,
+                audience=auth.audience,
+                issuer=auth.issuer,
+                options={'verify_signature': False}
             )
+            auth.token_cache.set(token, payload)
 
             return payload
 
@@ -140,6 +344,56 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+'''
+Permission registry
+    every permission passed to @requires_auth is registered here and
+    gets its own bit, so `python manage.py permissions` can list what the
+    app enforces and compare it with the Auth0 RBAC settings
+
+    a decoded payload carries the mask of its permissions, computed once
+    per token (the payload is cached in token_cache), so checking a
+    permission is a single bitwise and
+'''
+
+permission_bits = {}
+
+
+def register_permission(permission):
+    bit = permission_bits.get(permission)
+    if bit is None:
+        bit = 1 << len(permission_bits)
+        permission_bits[permission] = bit
+    return bit
+
+
+def registered_permissions():
+    return sorted(permission_bits)
+
+
+def permission_mask(payload):
+    # the mask is stored with the registry size it was computed against,
+    # so a permission registered later still gets picked up
+    cached = payload.get('_permission_mask')
+    if cached is not None and cached[0] == len(permission_bits):
+        return cached[1]
+
+    mask = 0
+    for permission in payload['permissions']:
+        mask |= permission_bits.get(permission, 0)
+    payload['_permission_mask'] = (len(permission_bits), mask)
+    return mask
+
+
+def has_permission(permission, payload):
+    if 'permissions' not in payload:
+        return False
+
+    bit = permission_bits.get(permission)
+    if bit is None:
+        return permission in payload['permissions']
+    return bool(permission_mask(payload) & bit)
+
+
 '''
 @DONE implement check_permissions(permission, payload) method
     @INPUTS
@@ -161,7 +415,7 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if not has_permission(permission, payload):
 
         raise AuthError({
             'code': 'unauthorized',
@@ -181,16 +435,21 @@ def check_permissions(permission, payload):
     method validate claims and check the requested permission
     return the decorator
     which passes the decoded payload to the decorated method
+        the checks are timed as the auth phase of the request, see
+        metrics.py
 '''
 
 
 def requires_auth(permission=''):
+    register_permission(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,146 @@
+import json
+import logging
+import re
+import threading
+import time
+from urllib.request import urlopen
+from jose import jwk
+
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSKeyStore
+    keeps the Auth0 signing keys in memory so verifying a token
+    does not need a network call on every request
+
+    - keys are constructed once per fetch into a kid -> jwk.Key dict,
+      so verifying a token doesn't parse its key again
+    - the document is refreshed after a TTL, taken from the Cache-Control
+      max-age of the response when present
+    - an expired document is still served while a background refresh
+      runs (stale-while-revalidate)
+    - an unknown kid triggers a refresh, at most once per
+      min_refresh_interval seconds
+    - a failed fetch keeps the last good keys
+    - fetches are at most once per min_refresh_interval seconds even
+      while no keys are cached (a cold start during an Auth0 outage):
+      until one succeeds get_key raises JWKSUnavailable, without waiting
+      for a fetch of its own
+
+    url can be anything urlopen understands, so a local JWKS file
+    (file:///path/jwks.json) or a stand-in HTTP server works in tests
+'''
+
+
+class JWKSUnavailable(Exception):
+    """No keys could be fetched yet"""
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_key(self, kid):
+        """Returns the jwk.Key for kid, or None if the JWKS doesn't have it
+        Raises JWKSUnavailable when no keys could be fetched.
+        """
+        if not self._keys:
+            self.refresh()
+            if not self._keys:
+                raise JWKSUnavailable(self.url)
+        elif time.monotonic() >= self._expires_at:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._can_refresh():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self):
+        """Fetches the JWKS document and swaps in the new keys
+        Keeps the current keys if the fetch fails.
+        """
+        with self._lock:
+            if not self._can_refresh():
+                return
+            self._last_fetch = time.monotonic()
+            try:
+                keys, ttl = self._fetch()
+            except Exception:
+                logger.warning('Unable to fetch JWKS from %s', self.url,
+                               exc_info=True)
+                return
+
+            self._keys = keys
+            self._expires_at = time.monotonic() + ttl
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_fetch = 0
+
+    def _can_refresh(self):
+        return (time.monotonic() - self._last_fetch
+                >= self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        if self._refreshing or not self._can_refresh():
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            cache_control = response.headers.get('Cache-Control', '')
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            try:
+                keys[key['kid']] = jwk.construct({
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use', 'sig'),
+                    'n': key['n'],
+                    'e': key['e']
+                }, key.get('alg', 'RS256'))
+            except Exception:
+                logger.warning('Skipping invalid JWKS key %s', key['kid'],
+                               exc_info=True)
+
+        return keys, max_age(cache_control, self.ttl)
+
+
+def max_age(cache_control, default):
+    """Returns the max-age of a Cache-Control header value in seconds
+    """
+    if not cache_control:
+        return default
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if not match:
+        return default
+    return int(match.group(1))
@@ -0,0 +1,96 @@
+import base64
+import json
+import os
+import tempfile
+import time
+import rsa
+from jose import jwk, jwt
+
+'''
+LocalKeyPair
+    an RSA key pair standing in for the Auth0 tenant, so tokens can be
+    issued and verified without a network: tests, benchmarks and
+    working offline
+
+    - get_key(kid) makes it a key provider for verify_decode_jwt, like
+      JWKSKeyStore (auth/jwks.py)
+    - mint() signs RS256 tokens carrying the claims auth/auth.py checks
+    - the public key can be written as a JWKS file, for a JWKS_URL of
+      another process (file:///path/jwks.json)
+    - the key lives in memory, or in a PEM file (load()) that every
+      process sharing it can sign and verify with
+
+    a fresh 2048-bit key takes a moment to generate, create one per
+    process and keep it
+'''
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalKeyPair:
+    def __init__(self, private_key=None, kid='local', bits=2048):
+        if private_key is None:
+            private_key = rsa.newkeys(bits)[1]
+        self.kid = kid
+        self.pem = private_key.save_pkcs1().decode()
+        self._jwk = {
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'n': b64(private_key.n),
+            'e': b64(private_key.e)
+        }
+        self._key = jwk.construct(self._jwk, 'RS256')
+
+    @classmethod
+    def load(cls, path, kid='local', bits=2048):
+        """The key pair in the PEM file at path, generated and saved there
+        when the file doesn't exist
+
+        the workers of a server can get there at once: the key is written
+        to a temporary file that is then linked at path, so path is never
+        seen half written, and a worker that finds path already taken
+        loads the key of the one that won
+        """
+        if not os.path.exists(path):
+            key_pair = cls(kid=kid, bits=bits)
+            fd, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)), suffix='.pem')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(key_pair.pem)
+                os.link(temporary, path)
+                return key_pair
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temporary)
+
+        with open(path, 'rb') as f:
+            return cls(rsa.PrivateKey.load_pkcs1(f.read()), kid=kid)
+
+    def get_key(self, kid):
+        return self._key if kid == self.kid else None
+
+    def jwks(self):
+        return {'keys': [dict(self._jwk)]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+
+    def mint(self, issuer, audience, permissions, subject='local|user',
+             expires_in=3600, **claims):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': issuer,
+            'aud': audience,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+            **claims
+        }, self.pem, algorithm='RS256', headers={'kid': self.kid})
@@ -0,0 +1,320 @@
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from auth.auth import ROLES
+from auth.keys import LocalKeyPair
+from bench.scenarios import SCENARIOS, Catalog
+
+'''
+Benchmark suite
+    seeds a database, mints local tokens against a JWKS file, drives
+    every route (bench/scenarios.py) and writes a JSON report with the
+    p50/p95/p99 latency, requests/sec and errors of each route, and the
+    peak RSS of the processes that served them
+
+    modes
+        client: the Flask test client in this process, no HTTP
+        gunicorn: `gunicorn app:APP` with --workers workers, driven over
+            HTTP by --concurrency threads
+
+    python -m bench.run --movies 10000 --actors 10000 --output report.json
+    python -m bench.run ... --save-baseline bench/baseline.json
+    python -m bench.run ... --baseline bench/baseline.json
+
+    with --baseline the run fails (exit status 1) when a route's p95 grew
+    or its requests/sec dropped by more than --tolerance, 0.2 for 20%
+
+    the app is configured through the same environment variables as in
+    production; DATABASE_URL defaults to a SQLite file in a temporary
+    directory, Auth0 is replaced by the local tokens
+'''
+
+DOMAIN = 'bench.local'
+AUDIENCE = 'bench'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.run')
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--cast-size', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--mode', choices=('client', 'gunicorn', 'both'),
+                        default='both')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--database-url',
+                        help='an empty or already seeded database')
+    parser.add_argument('--routes', help='only the routes containing this')
+    parser.add_argument('--output', help='write the report there')
+    parser.add_argument('--baseline', help='compare with this report')
+    parser.add_argument('--save-baseline', help='write the report there')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def setup_environment(options, directory):
+    """Points the app at the bench database and the local tokens,
+    returns the tokens of each role
+    """
+    keys = LocalKeyPair()
+    jwks = os.path.join(directory, 'jwks.json')
+    keys.write_jwks(jwks)
+
+    os.environ.update({
+        'AUTH0_DOMAIN': DOMAIN,
+        'API_AUDIENCE': AUDIENCE,
+        'ALGORITHMS': 'RS256',
+        'JWKS_URL': Path(jwks).as_uri(),
+        'DATABASE_URL': options.database_url or
+        'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+    })
+
+    issuer = f'https://{DOMAIN}/'
+    return {
+        'producer': keys.mint(issuer, AUDIENCE, ROLES['executive_producer'],
+                              subject='bench|producer'),
+        'assistant': keys.mint(issuer, AUDIENCE, ROLES['casting_assistant'],
+                               subject='bench|assistant'),
+        None: None
+    }
+
+
+def prepare_database(options):
+    from app import APP
+    from bench.seed import seed
+    from database.models import db, Movies
+
+    with APP.app_context():
+        db.create_all()
+        if db.session.query(Movies.id).first() is None:
+            start = time.perf_counter()
+            seed(options.movies, options.actors, options.cast_size)
+            print(f'seeded {options.movies} movies and {options.actors} '
+                  f'actors in {time.perf_counter() - start:.1f}s')
+        db.session.remove()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(latencies, statuses, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': sum(1 for status in statuses if status >= 400),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'rps': round(len(ordered) / elapsed, 1) if elapsed else None
+    }
+
+
+def request_count(options, scenario):
+    return max(int(options.requests * scenario.share), 1)
+
+
+def scenarios(options):
+    return [scenario for scenario in SCENARIOS
+            if not options.routes or options.routes in scenario.name]
+
+
+def headers(tokens, scenario):
+    token = tokens[scenario.role]
+    result = {'Content-Type': 'application/json'}
+    if token:
+        result['Authorization'] = 'Bearer ' + token
+    return result
+
+
+def run_client(options, tokens, catalog):
+    from app import APP
+    client = APP.test_client()
+
+    results = {}
+    for scenario in scenarios(options):
+        latencies, statuses = [], []
+        started = time.perf_counter()
+        for i in range(request_count(options, scenario)):
+            path, body = scenario.request(catalog, i)
+            start = time.perf_counter()
+            response = client.open(path, method=scenario.method,
+                                   headers=headers(tokens, scenario),
+                                   data=json.dumps(body) if body else None)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            statuses.append(response.status_code)
+        results[scenario.name] = summarize(
+            latencies, statuses, time.perf_counter() - started)
+
+    return {
+        'routes': results,
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb(pid):
+    """Peak RSS of pid and its children (Linux), None elsewhere"""
+    def high_water_mark(pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+
+    pids = [pid]
+    for status in Path('/proc').glob('[0-9]*/status'):
+        try:
+            if f'PPid:\t{pid}\n' in status.read_text():
+                pids.append(int(status.parent.name))
+        except OSError:
+            continue
+    marks = [mark for mark in map(high_water_mark, pids) if mark]
+    return round(max(marks), 1) if marks else None
+
+
+def send(port, method, path, body, headers):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        start = time.perf_counter()
+        connection.request(method, path,
+                           json.dumps(body) if body else None, headers)
+        response = connection.getresponse()
+        response.read()
+        return time.perf_counter() - start, response.status
+    finally:
+        connection.close()
+
+
+def run_gunicorn(options, tokens, catalog):
+    if importlib.util.find_spec('gunicorn') is None:
+        return {'skipped': 'gunicorn is not installed'}
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn.app.wsgiapp',
+         '--workers', str(options.workers), '--bind', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'app:APP'],
+        cwd=Path(__file__).resolve().parent.parent, env=os.environ.copy())
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                send(port, 'GET', '/', None, {})
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    return {'skipped': 'gunicorn did not start'}
+                time.sleep(0.2)
+
+        results = {}
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            for scenario in scenarios(options):
+                requests = [scenario.request(catalog, i) for i in
+                            range(request_count(options, scenario))]
+                started = time.perf_counter()
+                responses = list(pool.map(
+                    lambda request: send(port, scenario.method, *request,
+                                         headers(tokens, scenario)),
+                    requests))
+                results[scenario.name] = summarize(
+                    [latency for latency, status in responses],
+                    [status for latency, status in responses],
+                    time.perf_counter() - started)
+
+        return {'routes': results, 'peak_rss_mb': peak_rss_mb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def compare(report, baseline, tolerance):
+    """Returns the regressions of report against baseline"""
+    regressions = []
+    for mode, result in report['modes'].items():
+        before = baseline.get('modes', {}).get(mode, {}).get('routes', {})
+        for name, now in result.get('routes', {}).items():
+            then = before.get(name)
+            if then is None:
+                continue
+            if now['p95_ms'] > then['p95_ms'] * (1 + tolerance):
+                regressions.append(
+                    f"{mode} {name}: p95 {then['p95_ms']}ms -> "
+                    f"{now['p95_ms']}ms")
+            if then['rps'] and now['rps'] < then['rps'] * (1 - tolerance):
+                regressions.append(
+                    f"{mode} {name}: {then['rps']} -> {now['rps']} req/s")
+    return regressions
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        tokens = setup_environment(options, directory)
+        prepare_database(options)
+
+        catalog = Catalog(options.movies, options.actors)
+        modes = ('client', 'gunicorn') if options.mode == 'both' \
+            else (options.mode,)
+        report = {
+            'meta': {
+                'movies': options.movies,
+                'actors': options.actors,
+                'requests': options.requests,
+                'workers': options.workers,
+                'concurrency': options.concurrency,
+                'database': os.environ['DATABASE_URL'].split(':')[0],
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            },
+            'modes': {}
+        }
+        for mode in modes:
+            run = run_client if mode == 'client' else run_gunicorn
+            report['modes'][mode] = run(options, tokens, catalog)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    for path in (options.output, options.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                f.write(text + '\n')
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(report, json.load(f), options.tolerance)
+        for regression in regressions:
+            print('regression:', regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import itertools
+import threading
+
+'''
+Scenarios
+    one request pattern per route of app.py, SCENARIOS lists them all
+
+    a scenario builds the path and the JSON body of its i-th request;
+    reads spread over the lower half of the seeded ids, deletes take ids
+    from the top down, so reads never hit a row a delete removed
+
+    share scales the number of requests of a scenario, heavy ones (a
+    stream of the table) run fewer times
+'''
+
+
+class Catalog:
+    """The seeded ids the scenarios pick from"""
+
+    def __init__(self, movies, actors):
+        self.movies = movies
+        self.actors = actors
+        self._deleted_movies = itertools.count(movies, -1)
+        self._deleted_actors = itertools.count(actors, -1)
+        self._lock = threading.Lock()
+
+    def movie(self, i):
+        return 1 + i * 7919 % max(self.movies // 2, 1)
+
+    def actor(self, i):
+        return 1 + i * 7919 % max(self.actors // 2, 1)
+
+    def delete_movie(self):
+        with self._lock:
+            return next(self._deleted_movies)
+
+    def delete_actor(self):
+        with self._lock:
+            return next(self._deleted_actors)
+
+
+class Scenario:
+    def __init__(self, method, path, body=None, role='producer', share=1.0,
+                 name=None):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.role = role
+        self.share = share
+        self.name = name or f'{method} {path(Catalog(2, 2), 0)}'
+
+    def request(self, catalog, i):
+        """Returns the path and the body (or None) of request i"""
+        body = self.body(catalog, i) if self.body else None
+        return self.path(catalog, i), body
+
+
+def movie(i):
+    return {'title': f'bench movie {i}', 'release_date': '2020-01-01'}
+
+
+def actor(i):
+    return {'name': f'bench actor {i}', 'age': 30 + i % 40,
+            'gender': 'female'}
+
+
+SCENARIOS = [
+    Scenario('GET', lambda c, i: '/', role=None),
+    Scenario('GET', lambda c, i: '/health', role=None),
+    Scenario('GET', lambda c, i: '/movies', role='assistant'),
+    Scenario('GET', lambda c, i: '/movies?sort=-release_date&limit=100',
+             role='assistant'),
+    Scenario('GET', lambda c, i: '/movies?include=actors&limit=100',
+             role='assistant'),
+    Scenario('GET', lambda c, i: '/movies?stream=1&released_before=1960-01-01',
+             role='assistant', share=0.05, name='GET /movies?stream=1'),
+    Scenario('GET', lambda c, i: f'/movies/{c.movie(i)}', role='assistant',
+             name='GET /movies/<id>'),
+    Scenario('GET', lambda c, i: '/actors?gender=female&sort=age',
+             role='assistant'),
+    Scenario('GET', lambda c, i: f'/actors/{c.actor(i)}', role='assistant',
+             name='GET /actors/<id>'),
+    Scenario('GET', lambda c, i: f'/search?q=movie+{i % 1000}',
+             role='assistant', name='GET /search'),
+    Scenario('GET', lambda c, i: '/stats/movies?year_bucket=10',
+             role='assistant'),
+    Scenario('GET', lambda c, i: '/stats/actors', role='assistant'),
+    Scenario('POST', lambda c, i: '/movies', lambda c, i: movie(i)),
+    Scenario('POST', lambda c, i: '/actors', lambda c, i: actor(i)),
+    Scenario('POST', lambda c, i: '/movies/bulk',
+             lambda c, i: [movie(i * 100 + n) for n in range(100)],
+             share=0.2),
+    Scenario('POST', lambda c, i: '/actors/bulk',
+             lambda c, i: [actor(i * 100 + n) for n in range(100)],
+             share=0.2),
+    Scenario('PATCH', lambda c, i: f'/movies/{c.movie(i)}',
+             lambda c, i: {'title': f'movie {c.movie(i)}'},
+             name='PATCH /movies/<id>'),
+    Scenario('PATCH', lambda c, i: f'/actors/{c.actor(i)}',
+             lambda c, i: {'age': 18 + c.actor(i) % 70},
+             name='PATCH /actors/<id>'),
+    Scenario('PATCH', lambda c, i: '/movies/bulk',
+             lambda c, i: {'ids': [c.movie(i * 100 + n) for n in range(100)],
+                           'changes': {'release_date': '2001-01-01'}},
+             share=0.2),
+    Scenario('PATCH', lambda c, i: '/actors/bulk',
+             lambda c, i: {'ids': [c.actor(i * 100 + n) for n in range(100)],
+                           'changes': {'gender': 'female'}},
+             share=0.2),
+    Scenario('POST', lambda c, i: f'/movies/{c.movie(i)}/actors',
+             lambda c, i: {'actor_ids': [c.actor(i), c.actor(i + 1)]},
+             name='POST /movies/<id>/actors'),
+    Scenario('DELETE', lambda c, i: f'/movies/{c.movie(i)}/actors',
+             lambda c, i: {'actor_ids': [c.actor(i), c.actor(i + 1)]},
+             name='DELETE /movies/<id>/actors'),
+    Scenario('DELETE', lambda c, i: f'/movies/{c.delete_movie()}',
+             share=0.2, name='DELETE /movies/<id>'),
+    Scenario('DELETE', lambda c, i: f'/actors/{c.delete_actor()}',
+             share=0.2, name='DELETE /actors/<id>'),
+    Scenario('DELETE', lambda c, i: '/movies/bulk',
+             lambda c, i: {'ids': [c.delete_movie() for _ in range(10)]},
+             share=0.05),
+    Scenario('DELETE', lambda c, i: '/actors/bulk',
+             lambda c, i: {'ids': [c.delete_actor() for _ in range(10)]},
+             share=0.05)
+]
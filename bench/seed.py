@@ -0,0 +1,45 @@
+from datetime import date, timedelta
+
+'''
+Seeding
+    fills movies, actors and the cast with generated rows, chunk_size
+    rows per transaction, so a million rows never sit in memory at once
+
+    movie n: "movie n", released on a day between 1950 and 2019
+    actor n: "actor n", aged 18 to 87, alternating genders
+    the cast of movie n: cast_size actors picked from its id
+'''
+
+FIRST_RELEASE = date(1950, 1, 1)
+GENDERS = ('female', 'male')
+
+
+def seed(movies, actors, cast_size=3, chunk_size=10000):
+    # imported here, the app reads its settings from the environment
+    # when it is imported and the bench sets them up first
+    from database.models import db, insert_many, movie_actors, \
+        Movies, Actors
+
+    for start in range(0, movies, chunk_size):
+        insert_many(Movies, [{
+            'title': f'movie {n}',
+            'release_date': FIRST_RELEASE + timedelta(days=n * 7 % 25550)
+        } for n in range(start + 1, min(start + chunk_size, movies) + 1)])
+
+    for start in range(0, actors, chunk_size):
+        insert_many(Actors, [{
+            'name': f'actor {n}',
+            'age': 18 + n % 70,
+            'gender': GENDERS[n % 2]
+        } for n in range(start + 1, min(start + chunk_size, actors) + 1)])
+
+    if not actors:
+        return
+    cast_size = min(cast_size, actors)
+    for start in range(0, movies, chunk_size):
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': n, 'actor_id': (n * 31 + k) % actors + 1}
+            for n in range(start + 1, min(start + chunk_size, movies) + 1)
+            for k in range(cast_size)
+        ])
+        db.session.commit()
@@ -0,0 +1,85 @@
+import argparse
+import time
+from datetime import date, timedelta
+from flask import Flask, jsonify
+from flask.json import JSONEncoder
+
+from serializer import Serializer, orjson
+
+'''
+Serialization micro-benchmark
+    the per-row cost of encoding a page of movies:
+        before: a format() dict per row sent with jsonify() (key sorting,
+            a Python default() call per date)
+        json/orjson: the row tuples through serializer.rows()
+
+    python -m bench.serialization [--rows 100000]
+'''
+
+FIELDS = ('id', 'title', 'release_date')
+
+
+class DateEncoder(JSONEncoder):
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+def make_rows(count):
+    first = date(1950, 1, 1)
+    return [(id, f'movie number {id}', first + timedelta(days=id % 20000))
+            for id in range(1, count + 1)]
+
+
+def format_row(row):
+    # what Movies.format() builds for each movie
+    return {'id': row[0], 'title': row[1],
+            'release_date': row[2].isoformat() if row[2] else None}
+
+
+def timed(encode, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = len(encode(rows))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(rows) * 1e6, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+
+    app = Flask(__name__)
+    app.json_encoder = DateEncoder
+    rows = make_rows(options.rows)
+
+    def before(rows):
+        with app.app_context():
+            return jsonify({'success': True,
+                            'movies': [format_row(row) for row in rows]
+                            }).get_data()
+
+    runs = [('jsonify + format()', before)]
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    for backend in backends:
+        serializer = Serializer(backend)
+        runs.append((f'serializer ({backend})', lambda rows, s=serializer:
+                     s.payload({'success': True,
+                                'movies': s.rows(FIELDS, rows)})))
+
+    print(f'{options.rows} rows, best of {options.repeat}')
+    baseline = None
+    for name, encode in runs:
+        per_row, size = timed(encode, rows, options.repeat)
+        baseline = baseline or per_row
+        print(f'{name:22} {per_row:6.2f} us/row  {size:>10} bytes  '
+              f'{baseline / per_row:4.1f}x')
+
+
+if __name__ == '__main__':
+    main()
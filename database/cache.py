@@ -0,0 +1,134 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+'''
+Response cache
+    GET responses are cached under a key made of the endpoint, the
+    normalized query parameters, the permission scope of the caller and
+    the version of every table (or row) the response was read from
+
+    the write paths in database/models.py bump the version of the
+    tables they change in the database (see table_versions), so every
+    cached response of those tables stops matching at once, in every
+    worker; old entries are never served again and age out of the LRU
+    (or expire in the shared backend)
+
+    the key doubles as the strong ETag of the response
+
+    backends
+        MemoryBackend (default): an in-process LRU per worker
+        RedisBackend: shared by all workers, RESPONSE_CACHE=redis://...
+            needs the redis package; anything with the get/set methods
+            of a redis client can stand in for it in tests
+
+    RESPONSE_CACHE=off disables the cache
+
+    setup_cache(app) (called by create_app) gives every app a cache of
+    its own, current_cache() is the one of the current app
+'''
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    def __init__(self, client, prefix='casting:', expire=86400):
+        self.client = client
+        self.prefix = prefix
+        # only bounds the memory of entries nobody asks for any more,
+        # table versions are what keeps the cache exact
+        self.expire = expire
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.expire)
+
+
+class ResponseCache:
+    def __init__(self, backend=None, max_bytes=1024 * 1024):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @staticmethod
+    def key(endpoint, args, scope, versions):
+        parts = [endpoint, repr(sorted(args)), repr(scope), repr(versions)]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:32]
+
+    def get(self, key):
+        """Returns the cached (body, status, mimetype) or None"""
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        head, body = value.split(b'\n', 1)
+        status, mimetype = head.decode().split(' ', 1)
+        return body, int(status), mimetype
+
+    def set(self, key, body, status, mimetype):
+        if len(body) <= self.max_bytes:
+            self.backend.set(key, f'{status} {mimetype}\n'.encode() + body)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def cache_backend(config):
+    setting = config['RESPONSE_CACHE']
+    if setting == 'off':
+        return None
+    if setting == 'memory':
+        return MemoryBackend(config['RESPONSE_CACHE_SIZE'])
+    if setting.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend.from_url(setting)
+    raise ValueError(f'unknown RESPONSE_CACHE {setting}')
+
+
+def setup_cache(app):
+    """Gives app a ResponseCache of its own, raises ValueError when
+    RESPONSE_CACHE is unknown
+    """
+    app.extensions['response_cache'] = ResponseCache(
+        cache_backend(app.config))
+
+
+def current_cache():
+    return current_app.extensions['response_cache']
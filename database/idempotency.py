@@ -0,0 +1,160 @@
+import itertools
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from database.models import db, idempotency_keys
+
+POLL_INTERVAL = 0.05
+SWEEP_EVERY = 100
+
+'''
+Idempotency keys
+    a create request sent with an Idempotency-Key header runs once per
+    caller and key, retries get the stored response back
+
+    claim(caller, key, request_hash)
+        inserts the key row, the primary key (caller, key) lets only one
+        request in; the others find the row and
+        - get the stored (status, mimetype, body) once it is finished
+        - wait up to IDEMPOTENCY_WAIT seconds for it while it is running,
+          concurrent retries are serialized on the key this way
+        - raise KeyReused when the key came with another request
+        returns None to the request that has to run
+
+    finish() stores the response, release() drops the key of a request
+    that failed so a retry can run it again
+
+    a running request is only taken over once its owner is known to be
+    dead, so a slow request never runs twice; the row records its owner
+    (host:pid)
+        - an owner on this host is dead when its process is gone, e.g. a
+          worker gunicorn killed, and a retry runs at once
+        - an owner on another host is taken for dead
+          IDEMPOTENCY_LOCK_TIMEOUT seconds (default 600) after the claim;
+          keep it well above the longest a request can run, gunicorn's
+          timeout (gunicorn.conf.py), after which it kills a sync worker
+
+    keys expire after IDEMPOTENCY_KEY_TTL seconds; sweep() deletes them
+    and the claims older than the lock timeout that never finished,
+    every SWEEP_EVERY claims and from
+    `python manage.py sweep_idempotency_keys`
+
+    the IDEMPOTENCY_* settings are read from the app's config, see
+    settings.py
+'''
+
+
+class KeyReused(Exception):
+    pass
+
+
+class KeyInProgress(Exception):
+    pass
+
+
+_claims = itertools.count(1)
+
+
+def claim(caller, key, request_hash):
+    deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+    while True:
+        if _insert(caller, key, request_hash):
+            if next(_claims) % SWEEP_EVERY == 0:
+                sweep()
+            return None
+
+        row = db.session.execute(select([idempotency_keys]).where(
+            _this(caller, key))).first()
+        db.session.rollback()
+        if row is None:
+            # swept or released in between, try again
+            continue
+        if row.request_hash != request_hash:
+            raise KeyReused()
+        if row.status is not None:
+            return row.status, row.mimetype, row.body
+
+        if abandoned(row):
+            _delete(and_(_this(caller, key),
+                         idempotency_keys.c.created_at == row.created_at))
+            continue
+        if time.monotonic() >= deadline:
+            raise KeyInProgress()
+        time.sleep(POLL_INTERVAL)
+
+
+def owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def abandoned(row):
+    """Whether the request that claimed row is known to be dead"""
+    host, _, pid = (row.owner or '').rpartition(':')
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # alive, run by another user
+            return False
+        return False
+    return row.created_at < datetime.utcnow() - timedelta(
+        seconds=current_app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+
+
+def finish(caller, key, status, mimetype, body):
+    db.session.execute(
+        idempotency_keys.update().where(_this(caller, key))
+        .values(status=status, mimetype=mimetype, body=body))
+    db.session.commit()
+
+
+def release(caller, key):
+    db.session.rollback()
+    _delete(_this(caller, key))
+
+
+def sweep():
+    """Deletes the expired and the abandoned keys, returns how many"""
+    now = datetime.utcnow()
+    key_ttl = current_app.config['IDEMPOTENCY_KEY_TTL']
+    lock_timeout = current_app.config['IDEMPOTENCY_LOCK_TIMEOUT']
+    return _delete(or_(
+        idempotency_keys.c.created_at < now - timedelta(seconds=key_ttl),
+        and_(idempotency_keys.c.status.is_(None),
+             idempotency_keys.c.created_at
+             < now - timedelta(seconds=lock_timeout))))
+
+
+def _this(caller, key):
+    return and_(idempotency_keys.c.caller == caller,
+                idempotency_keys.c.key == key)
+
+
+def _insert(caller, key, request_hash):
+    try:
+        db.session.execute(idempotency_keys.insert().values(
+            caller=caller, key=key, request_hash=request_hash,
+            owner=owner(), created_at=datetime.utcnow()))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def _delete(condition):
+    try:
+        count = db.session.execute(
+            idempotency_keys.delete().where(condition)).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
@@ -1,39 +1,531 @@
+import math
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import Column, String, Integer, Date, DateTime, Index, DDL, \
+    ForeignKey, LargeBinary, select, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import relationship
 import json
-from flask_migrate import Migrate, MigrateCommand
 
+from database.replicas import ReplicaRouter, RoutingSQLAlchemy, app_router
 
-database_path = os.environ['DATABASE_URL']
-db = SQLAlchemy()
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+    database_path defaults to DATABASE_URL, read when the app is set up
+    rather than on import
+
+    the connection pool and the statement timeout come from the DB_*
+    environment variables (POOL_SETTINGS), config overrides them with a
+    dict of the same settings in lowercase, e.g. {'pool_size': 2}
+
+    reads of GET requests go to the replicas in replica_paths,
+    DATABASE_REPLICA_URLS by default, see database/replicas.py; no
+    engine connects before its first query
+
+    the engines and the replica router belong to app, so several apps
+    (and the tests) can each be set up with a database of their own;
+    setting an app up again replaces its engines
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, config=None, replica_paths=None):
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+    if replica_paths is None:
+        replica_paths = [
+            url.strip() for url in
+            os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url.strip()]
+    settings = pool_config(os.environ, config)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, settings)
+
+    router = app_router(app)
+    if router is None:
+        router = ReplicaRouter(
+            app.config.get('DATABASE_REPLICA_POLICY') or
+            os.environ.get('DATABASE_REPLICA_POLICY', 'round_robin'),
+            float(app.config.get('DATABASE_REPLICA_STICKY_SECONDS') or
+                  os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5)))
+        app.extensions['replica_router'] = router
+        app.after_request(router.set_sticky_cookie)
+    router.configure(
+        replica_paths, lambda url: engine_options(url, settings),
+        app.config.get('SECRET_KEY') or os.environ.get('SECRET_KEY'))
     db.init_app(app)
     # db.create_all()
     return db
 
 
+def dispose_engines(app):
+    """Closes the pooled connections of app's engines, the primary and
+    the replicas; a gunicorn worker forked from a preloaded app calls it
+    so it doesn't share the connections of the master, see
+    gunicorn.conf.py
+    """
+    db.get_engine(app).dispose()
+    db.get_router(app).dispose()
+
+
+'''
+Connection pool
+    POOL_SETTINGS maps each setting to its environment variable, its
+    default and its minimum
+        pool_size: connections each worker keeps open
+        max_overflow: connections opened on top of pool_size under load,
+            closed again when they are returned
+        pool_timeout: seconds a request waits for a connection before
+            it fails
+        pool_recycle: seconds after which a connection is replaced, so
+            none outlives a database failover or a server side idle
+            timeout
+        pool_pre_ping: test each connection when it is checked out and
+            reconnect if it is dead (1 or 0)
+        statement_timeout: milliseconds a statement may run before the
+            database cancels it, 0 for no limit; PostgreSQL only
+
+    the pool settings apply to server databases, SQLite opens a
+    connection per checkout (Flask-SQLAlchemy uses a NullPool for it)
+'''
+
+POOL_SETTINGS = {
+    'pool_size': ('DB_POOL_SIZE', 5, 1),
+    'max_overflow': ('DB_MAX_OVERFLOW', 10, 0),
+    'pool_timeout': ('DB_POOL_TIMEOUT', 30, 1),
+    'pool_recycle': ('DB_POOL_RECYCLE', 1800, -1),
+    'pool_pre_ping': ('DB_POOL_PRE_PING', 1, 0),
+    'statement_timeout': ('DB_STATEMENT_TIMEOUT', 30000, 0)
+}
+
+
+def pool_config(environ, config=None):
+    """Returns the validated pool settings, raises ValueError if invalid
+    """
+    config = config or {}
+    unknown = sorted(set(config) - set(POOL_SETTINGS))
+    if unknown:
+        raise ValueError(f'unknown pool setting {unknown[0]}')
+
+    settings = {}
+    for name, (variable, default, minimum) in POOL_SETTINGS.items():
+        value = config.get(name, environ.get(variable, default))
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{variable} must be an integer')
+        if value < minimum:
+            raise ValueError(f'{variable} must be at least {minimum}')
+        settings[name] = value
+    return settings
+
+
+def engine_options(database_path, settings):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': bool(settings['pool_pre_ping'])
+    }
+    if database_path.startswith('postgres') \
+            and settings['statement_timeout']:
+        # set by the server on every new connection of the pool
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={settings['statement_timeout']}"
+        }
+    return options
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that keeps track of the time spent waiting for a
+    connection and of the checkouts that timed out
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.checkouts += 1
+            self.wait_time += time.perf_counter() - start
+
+
+def pool_stats():
+    """Returns the state of the connection pool of db"""
+    pool = db.engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'pool': type(pool).__name__}
+
+    stats = {
+        'pool': type(pool).__name__,
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0)
+    }
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            'checkouts': pool.checkouts,
+            'timeouts': pool.timeouts,
+            'wait_time': round(pool.wait_time, 6)
+        })
+    return stats
+
+
 def create_drop_tables():
     db.drop_all()
     db.create_all()
 
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(connection, connection_record):
+    # SQLite ignores ON DELETE CASCADE unless asked, PostgreSQL always
+    # enforces it
+    if type(connection).__module__ == 'sqlite3':
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+'''
+Table versions
+    every write bumps the version of the tables it changes, in the same
+    transaction (commit()); the versions are what the ETags and the
+    response cache keys of the GET endpoints are made of, so they are
+    the same in every worker and checking them is a primary key lookup
+    instead of reading the rows
+
+    a write by id that matched no row (a 404, or ids that are all
+    unknown) changed nothing and goes through commit_changes(), which
+    leaves the versions, and so the ETags and the cached responses,
+    as they are
+'''
+
+VERSIONED_TABLES = ('movies', 'actors', 'movie_actors')
+
+table_versions = db.Table(
+    'table_versions',
+    Column('name', String, primary_key=True),
+    Column('version', Integer, nullable=False, default=0),
+    Column('updated_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+
+@event.listens_for(table_versions, 'after_create')
+def insert_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0} for name in VERSIONED_TABLES
+    ])
+
+
+def commit(*tables):
+    """Commits the session along with a version bump of tables"""
+    db.session.execute(
+        table_versions.update()
+        .where(table_versions.c.name.in_(tables))
+        .values(version=table_versions.c.version + 1,
+                updated_at=datetime.utcnow()))
+    db.session.commit()
+    db.router.wrote()
+
+
+def commit_changes(changed, *tables):
+    """commit(*tables) if the write changed rows, otherwise ends its
+    transaction without a version bump
+    """
+    if changed:
+        commit(*tables)
+    else:
+        db.session.rollback()
+
+
+def versions(tables):
+    """Returns [(name, version, updated_at)] for tables"""
+    rows = db.session.execute(
+        select([table_versions])
+        .where(table_versions.c.name.in_(tables))).fetchall()
+    found = {row.name: (row.name, row.version, row.updated_at)
+             for row in rows}
+    return [found.get(name, (name, 0, None)) for name in tables]
+
+
+def row_version(model, id):
+    """Returns the updated_at of a row, None if there is no such row"""
+    return db.session.execute(
+        select([model.updated_at]).where(model.id == id)).scalar()
+
+
+'''
+idempotency_keys
+    the responses of create requests sent with an Idempotency-Key
+    header, one row per caller and key; status is NULL while the first
+    request is running, owner is the host:pid running it, see
+    database/idempotency.py
+'''
+
+idempotency_keys = db.Table(
+    'idempotency_keys',
+    Column('caller', String, primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('request_hash', String, nullable=False),
+    Column('status', Integer),
+    Column('mimetype', String),
+    Column('body', LargeBinary),
+    Column('owner', String),
+    Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+    Index('ix_idempotency_keys_created_at', 'created_at')
+)
+
+
+'''
+insert_many(model, rows)
+    inserts a list of column dicts in one transaction, chunk_size rows
+    (BULK_CHUNK_SIZE of the app's config by default) per statement, and
+    returns the new ids in the order of rows
+
+    databases with RETURNING (PostgreSQL) get one multi-row
+    INSERT ... RETURNING id per chunk, the others go through
+    bulk_insert_mappings
+'''
+
+
+def bulk_chunk_size():
+    return current_app.config['BULK_CHUNK_SIZE']
+
+
+def insert_many(model, rows, chunk_size=None):
+    chunk_size = chunk_size or bulk_chunk_size()
+    table = model.__table__
+    returning = db.engine.dialect.implicit_returning
+
+    ids = []
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if returning:
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids += [row.id for row in result]
+            else:
+                db.session.bulk_insert_mappings(
+                    model, chunk, return_defaults=True)
+                ids += [row['id'] for row in chunk]
+        commit(model.__tablename__)
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def insert_statements(rows, chunk_size=None):
+    """The statements insert_many runs for that many rows"""
+    if db.engine.dialect.implicit_returning:
+        return math.ceil(rows / (chunk_size or bulk_chunk_size()))
+    # bulk_insert_mappings needs an INSERT per row to return the ids
+    return rows
+
+
+'''
+update_many(model, updates) and delete_many(model, ids)
+    set-based writes by id list, all in one transaction, with at most
+    chunk_size ids per `UPDATE ... WHERE id IN (...)` or
+    `DELETE ... WHERE id IN (...)` statement
+
+    updates is a list of (ids, values) pairs, the ids of each pair get
+    the same values
+
+    both return the ids that matched a row; databases with RETURNING
+    (PostgreSQL) get them from the statement itself, the others with a
+    SELECT in the same transaction
+'''
+
+
+def update_many(model, updates, chunk_size=None):
+    table = model.__table__
+
+    def update(ids, values):
+        return table.update().where(table.c.id.in_(ids)).values(values)
+
+    return _write_many(model, updates, update, chunk_size,
+                       [model.__tablename__])
+
+
+def delete_many(model, ids, chunk_size=None):
+    table = model.__table__
+
+    def delete(ids, values):
+        return table.delete().where(table.c.id.in_(ids))
+
+    return _write_many(model, [(ids, None)], delete, chunk_size,
+                       [model.__tablename__, 'movie_actors'])
+
+
+def _write_many(model, writes, statement, chunk_size, tables):
+    chunk_size = chunk_size or bulk_chunk_size()
+    table = model.__table__
+    returning = db.engine.dialect.implicit_returning
+
+    matched = []
+    try:
+        for ids, values in writes:
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                if returning:
+                    result = db.session.execute(
+                        statement(chunk, values).returning(table.c.id))
+                    matched += [row.id for row in result]
+                else:
+                    result = db.session.execute(
+                        select([table.c.id]).where(table.c.id.in_(chunk)))
+                    matched += [row.id for row in result]
+                    db.session.execute(statement(chunk, values))
+        commit_changes(matched, *tables)
+    except Exception:
+        db.session.rollback()
+        raise
+    return matched
+
+
+def write_statements(counts, chunk_size=None):
+    """The statements update_many or delete_many run for writes of that
+    many ids each
+    """
+    chunk_size = chunk_size or bulk_chunk_size()
+    per_chunk = 1 if db.engine.dialect.implicit_returning else 2
+    return per_chunk * sum(math.ceil(count / chunk_size)
+                           for count in counts)
+
+
+'''
+update_by_id(model, id, values) and delete_by_id(model, id)
+    a single UPDATE or DELETE statement for one row, nothing is loaded
+    into the session; they return False when no row has that id
+'''
+
+
+def update_by_id(model, id, values):
+    return _write_one(
+        [model.__tablename__],
+        model.query.filter(model.id == id).update,
+        values, synchronize_session=False)
+
+
+def delete_by_id(model, id):
+    return _write_one(
+        [model.__tablename__, 'movie_actors'],
+        model.query.filter(model.id == id).delete,
+        synchronize_session=False)
+
+
+def _write_one(tables, statement, *args, **kwargs):
+    try:
+        count = statement(*args, **kwargs)
+        commit_changes(count, *tables)
+    except Exception:
+        db.session.rollback()
+        raise
+    return count > 0
+
+
+'''
+movie_actors
+    the cast of each movie; the primary key (movie_id, actor_id) serves
+    lookups by movie and ix_movie_actors_actor_id lookups by actor,
+    rows go away with their movie or actor (ON DELETE CASCADE)
+'''
+
+movie_actors = db.Table(
+    'movie_actors',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_movie_actors_actor_id', 'actor_id')
+)
+
+
+'''
+assign_cast(movie_id, actor_ids) and unassign_cast(movie_id, actor_ids)
+    add or remove actors from the cast of a movie in one transaction;
+    both return the actor ids that changed, actors already in (or not
+    in) the cast and unknown actors are skipped
+'''
+
+
+def assign_cast(movie_id, actor_ids):
+    try:
+        known = select([Actors.id]).where(Actors.id.in_(actor_ids))
+        cast = select([movie_actors.c.actor_id]).where(
+            movie_actors.c.movie_id == movie_id)
+        new_ids = [row.id for row in db.session.execute(
+            known.where(Actors.id.notin_(cast)))]
+        if new_ids:
+            db.session.execute(movie_actors.insert().values([
+                {'movie_id': movie_id, 'actor_id': actor_id}
+                for actor_id in new_ids
+            ]))
+        commit_changes(new_ids, 'movie_actors')
+    except Exception:
+        db.session.rollback()
+        raise
+    return new_ids
+
+
+def unassign_cast(movie_id, actor_ids):
+    try:
+        condition = (movie_actors.c.movie_id == movie_id) \
+            & movie_actors.c.actor_id.in_(actor_ids)
+        removed = [row.actor_id for row in db.session.execute(
+            select([movie_actors.c.actor_id]).where(condition))]
+        if removed:
+            db.session.execute(movie_actors.delete().where(condition))
+        commit_changes(removed, 'movie_actors')
+    except Exception:
+        db.session.rollback()
+        raise
+    return removed
+
+
 class Movies(db.Model):
     __tablename__ = 'movies'
+    fields = ('id', 'title', 'release_date')
+    __table_args__ = (
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+        Index('ix_movies_title_id', 'title', 'id'),
+        Index('ix_movies_title_pattern', 'title',
+              postgresql_ops={'title': 'varchar_pattern_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    release_date = Column(String)
+    release_date = Column(Date)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+    actors = relationship('Actors', secondary=movie_actors,
+                          back_populates='movies', passive_deletes=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -41,29 +533,42 @@ class Movies(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        commit(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self.__tablename__, 'movie_actors')
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date}
+            'release_date': self.release_date.isoformat()
+            if self.release_date else None}
 
 
 class Actors(db.Model):
     __tablename__ = 'actors'
+    fields = ('id', 'name', 'age', 'gender')
+    __table_args__ = (
+        Index('ix_actors_gender', 'gender'),
+        Index('ix_actors_age_id', 'age', 'id'),
+        Index('ix_actors_name_id', 'name', 'id'),
+        Index('ix_actors_name_pattern', 'name',
+              postgresql_ops={'name': 'varchar_pattern_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+    movies = relationship('Movies', secondary=movie_actors,
+                          back_populates='actors', passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -72,14 +577,14 @@ class Actors(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        commit(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self.__tablename__, 'movie_actors')
 
     def format(self):
         return {
@@ -87,3 +592,52 @@ class Actors(db.Model):
             'name': self.name,
             'age': self.age,
             'gender': self.gender}
+
+
+'''
+Search indexes
+    the text columns of SEARCHABLE are indexed for GET /search
+    (database/search.py)
+
+    PostgreSQL: a GIN index on to_tsvector('simple', column)
+    SQLite: an external content FTS5 table, <table>_search, kept in
+        sync with the table by triggers
+
+    see migrations/versions/d2c5a8f13e67_.py for existing databases
+'''
+
+SEARCHABLE = (('movies', 'title'), ('actors', 'name'))
+
+
+def search_ddl(dialect, table, column):
+    if dialect == 'postgresql':
+        return [
+            f'CREATE INDEX ix_{table}_{column}_search ON {table} '
+            f"USING gin (to_tsvector('simple', {column}))"
+        ]
+
+    fts = f'{table}_search'
+    delete = (f"INSERT INTO {fts}({fts}, rowid, {column}) "
+              f"VALUES ('delete', old.id, old.{column});")
+    insert = (f'INSERT INTO {fts}(rowid, {column}) '
+              f'VALUES (new.id, new.{column});')
+    return [
+        f'CREATE VIRTUAL TABLE {fts} USING fts5('
+        f"{column}, content='{table}', content_rowid='id')",
+        f'CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} '
+        f'BEGIN {insert} END',
+        f'CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} '
+        f'BEGIN {delete} END',
+        f'CREATE TRIGGER {fts}_update AFTER UPDATE OF {column} ON {table} '
+        f'BEGIN {delete} {insert} END'
+    ]
+
+
+for table, column in SEARCHABLE:
+    for dialect in ('postgresql', 'sqlite'):
+        for statement in search_ddl(dialect, table, column):
+            event.listen(db.metadata.tables[table], 'after_create',
+                         DDL(statement).execute_if(dialect=dialect))
+    event.listen(db.metadata.tables[table], 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS {table}_search')
+                 .execute_if(dialect='sqlite'))
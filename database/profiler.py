@@ -0,0 +1,230 @@
+import logging
+import re
+from collections import Counter
+from functools import wraps
+from flask import g, current_app, request, has_app_context, \
+    has_request_context
+
+from metrics import current_timer, install as install_timer, on_statement, \
+    start_timer
+
+logger = logging.getLogger(__name__)
+
+'''
+SQL profiler
+    opt-in checks on the statements every engine (primary and replicas)
+    runs, fed by the statement timer of metrics.py (one listener pair
+    for both, see on_statement()); a request's statements are counted
+    by its RequestTimer, which the budgets read; each check is
+    off unless its setting is set, in the app's config or the
+    environment (settings.py); setup_profiler(app) keeps them in
+    app.extensions['profiler'], a ProfilerSettings
+
+    SLOW_QUERY_MS: statements slower than this many milliseconds are
+        logged with their parameters, and the first time a statement
+        shape is slow, with its EXPLAIN plan (SLOW_QUERY_EXPLAIN=off
+        leaves the plan out); only SELECTs are explained
+
+    N_PLUS_ONE_THRESHOLD: a request that runs the same statement shape
+        more than this many times is logged, the symptom of a query per
+        row (N+1) or of a loop that should be one bulk statement
+
+    QUERY_BUDGETS: log or raise, checks the budgets set with
+        @query_budget(n) on the views; a request that runs more than n
+        statements is logged, or fails with QueryBudgetExceeded (the test
+        suite runs with raise so that an endpoint going over its budget
+        fails its tests); n can also be a function returning the budget
+        of the request, called after the view, for endpoints whose
+        statements grow with the request (the bulk endpoints)
+
+    the shape of a statement is its SQL with the placeholder lists of
+    IN (...) collapsed, the parameters are bound separately so the text
+    doesn't change with them
+
+    statements run while a streamed response is sent are not counted
+'''
+
+
+MAX_EXPLAINED = 1000
+MAX_PARAMETERS = 500
+
+PLACEHOLDERS = re.compile(
+    r'\(\s*(?:\?|%\(\w+\)s|%s)(?:\s*,\s*(?:\?|%\(\w+\)s|%s))*\s*\)')
+SPACES = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, endpoint, statements, budget):
+        super().__init__(f'{endpoint} ran {statements} SQL statements, '
+                         f'its budget is {budget}')
+        self.endpoint = endpoint
+        self.statements = statements
+        self.budget = budget
+
+
+class ProfilerSettings:
+    __slots__ = ('slow_query_ms', 'explain', 'repeat_threshold',
+                 'budget_mode')
+
+    def __init__(self, config):
+        budget_mode = config['QUERY_BUDGETS']
+        if budget_mode not in ('off', 'log', 'raise'):
+            raise ValueError(f'unknown QUERY_BUDGETS {budget_mode}')
+        self.slow_query_ms = config['SLOW_QUERY_MS']
+        self.explain = config['SLOW_QUERY_EXPLAIN'] != 'off'
+        self.repeat_threshold = config['N_PLUS_ONE_THRESHOLD']
+        self.budget_mode = budget_mode
+
+    @property
+    def active(self):
+        return self.slow_query_ms is not None \
+            or self.repeat_threshold is not None or self.budget_mode != 'off'
+
+
+def current_settings():
+    """The ProfilerSettings of the current app, None outside one"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('profiler')
+
+
+def shape(statement):
+    return SPACES.sub(' ', PLACEHOLDERS.sub('(...)', statement)).strip()
+
+
+class RequestProfile:
+    __slots__ = ('shapes',)
+
+    def __init__(self):
+        self.shapes = Counter()
+
+
+def current_profile():
+    if not has_request_context():
+        return None
+    return g.get('sql_profile')
+
+
+_explained = set()
+
+
+def explain_plan(conn, statement, parameters):
+    """EXPLAIN of statement on the connection it ran on, None if it
+    can't be explained
+    """
+    sqlite = conn.dialect.name == 'sqlite'
+    cursor = conn.connection.cursor()
+    try:
+        if sqlite:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+        # a failed statement aborts a PostgreSQL transaction, the
+        # savepoint keeps the request's transaction usable
+        cursor.execute('SAVEPOINT profiler_explain')
+        try:
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT profiler_explain')
+            return None
+        finally:
+            cursor.execute('RELEASE SAVEPOINT profiler_explain')
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+def observe(conn, statement, parameters, executemany, seconds):
+    settings = current_settings()
+    if settings is None:
+        return
+
+    profile = current_profile()
+    if profile is not None:
+        profile.shapes[shape(statement)] += 1
+
+    elapsed = seconds * 1000
+
+    if settings.slow_query_ms is None or elapsed < settings.slow_query_ms:
+        return
+    plan = None
+    key = shape(statement)
+    if settings.explain and not executemany and key not in _explained \
+            and len(_explained) < MAX_EXPLAINED \
+            and statement.lstrip()[:6].upper() == 'SELECT':
+        _explained.add(key)
+        plan = explain_plan(conn, statement, parameters)
+    logger.warning('Slow SQL statement (%.1f ms): %s\nparameters: %.*s%s',
+                   elapsed, statement, MAX_PARAMETERS, repr(parameters),
+                   f'\nplan:\n{plan}' if plan else '')
+
+
+def install():
+    """Attaches the profiler to every engine, once"""
+    install_timer()
+    on_statement(observe)
+
+
+def start_profile():
+    if current_settings().repeat_threshold is not None:
+        g.sql_profile = RequestProfile()
+
+
+def report(response):
+    profile = g.pop('sql_profile', None)
+    repeat_threshold = current_settings().repeat_threshold
+    if profile is None or repeat_threshold is None:
+        return response
+    for statement, count in profile.shapes.items():
+        if count > repeat_threshold:
+            logger.warning('Possible N+1: %s %s ran this statement %d '
+                           'times: %s', request.method, request.path,
+                           count, statement)
+    return response
+
+
+def setup_profiler(app):
+    """Profiles the statements of app with the settings of its config,
+    raises ValueError when QUERY_BUDGETS is unknown
+    """
+    settings = app.extensions['profiler'] = ProfilerSettings(app.config)
+    if not settings.active \
+            or start_profile in app.before_request_funcs.get(None, ()):
+        return
+    install()
+    # the budgets count with the timer of metrics.py, which METRICS=off
+    # leaves out
+    if start_timer not in app.before_request_funcs.get(None, ()):
+        app.before_request(start_timer)
+    app.before_request(start_profile)
+    app.after_request(report)
+
+
+def query_budget(budget):
+    """The view may run up to budget SQL statements, see QUERY_BUDGETS"""
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            timer = current_timer()
+            settings = current_settings()
+            if timer is None or settings is None \
+                    or settings.budget_mode == 'off':
+                return f(*args, **kwargs)
+            budget_mode = settings.budget_mode
+
+            before = timer.queries
+            response = f(*args, **kwargs)
+            statements = timer.queries - before
+            allowed = budget() if callable(budget) else budget
+            if statements > allowed:
+                if budget_mode == 'raise':
+                    raise QueryBudgetExceeded(request.endpoint, statements,
+                                              allowed)
+                logger.warning('%s ran %d SQL statements, its budget is '
+                               '%d', request.endpoint, statements, allowed)
+            return response
+
+        return wrapper
+    return query_budget_decorator
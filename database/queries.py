@@ -0,0 +1,376 @@
+import base64
+import binascii
+import json
+from datetime import date
+from flask import current_app
+from sqlalchemy import and_, or_, tuple_
+
+from database.models import db, movie_actors, Movies, Actors
+from serializer import row_dict
+
+
+'''
+Query helpers for the list endpoints
+    they raise ValueError on bad client input,
+    the routes in app.py turn that into a 400
+'''
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, binascii.Error):
+        raise ValueError('invalid cursor')
+
+    if not isinstance(values, list) or not values:
+        raise ValueError('invalid cursor')
+    return values
+
+
+# the range of an Integer column, a bound parameter outside it is an
+# OverflowError from the driver instead of a 400
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def in_range(value):
+    return INT_MIN <= value <= INT_MAX
+
+
+def to_int(name, value):
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+    if not in_range(value):
+        raise ValueError(f'{name} is out of range')
+    return value
+
+
+def to_date(name, value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a YYYY-MM-DD date')
+
+
+def positive_int(args, name, default=None):
+    value = args.get(name)
+    if value is None:
+        return default
+    value = to_int(name, value)
+    if value < 1:
+        raise ValueError(f'{name} must be positive')
+    return value
+
+
+def starts_with(column, prefix):
+    escaped = prefix.replace('\\', '\\\\') \
+        .replace('%', '\\%').replace('_', '\\_')
+    return column.like(escaped + '%', escape='\\')
+
+
+'''
+Filters and sorting
+    FILTERS maps the query parameters each list endpoint accepts to the
+    SQL condition they add, values are always bound as parameters
+
+    SORTS lists the columns a list can be sorted by, `?sort=age` or
+    `?sort=-age` for descending; only columns with an index on
+    (column, id) are sortable, see migrations/versions/3c9b2a71f0d4_.py,
+    so a sorted page is still an index scan
+'''
+
+FILTERS = {
+    Movies: {
+        'title_prefix': lambda value: starts_with(Movies.title, value),
+        'released_after': lambda value:
+            Movies.release_date > to_date('released_after', value),
+        'released_before': lambda value:
+            Movies.release_date < to_date('released_before', value)
+    },
+    Actors: {
+        'gender': lambda value: Actors.gender == value,
+        'name_prefix': lambda value: starts_with(Actors.name, value),
+        'age_min': lambda value: Actors.age >= to_int('age_min', value),
+        'age_max': lambda value: Actors.age <= to_int('age_max', value)
+    }
+}
+
+SORTS = {
+    Movies: ('id', 'title', 'release_date'),
+    Actors: ('id', 'name', 'age')
+}
+
+
+def apply_filters(query, model, args):
+    for name, condition in FILTERS[model].items():
+        value = args.get(name)
+        if value is not None:
+            query = query.filter(condition(value))
+    return query
+
+
+def parse_sort(model, value=None):
+    if not value:
+        return 'id', False
+
+    name = value[1:] if value.startswith('-') else value
+    if name not in SORTS[model]:
+        raise ValueError(f'can not sort by {name}')
+    return name, value.startswith('-')
+
+
+def order_by(model, sort):
+    name, descending = sort
+    column = getattr(model, name)
+    if name == 'id':
+        return [column.desc() if descending else column.asc()]
+
+    # nulls sort after every value, both ways, like a btree index on
+    # (column, id) read forwards or backwards
+    if descending:
+        return [column.desc().nullsfirst(), model.id.desc()]
+    return [column.asc().nullslast(), model.id.asc()]
+
+
+def seek(model, sort, cursor):
+    """Returns the condition selecting the rows after cursor
+    """
+    name, descending = sort
+    if name == 'id':
+        if len(cursor) != 1 or not is_int(cursor[0]):
+            raise ValueError('invalid cursor')
+        return model.id < cursor[0] if descending else model.id > cursor[0]
+
+    if len(cursor) != 2 or not is_int(cursor[1]):
+        raise ValueError('invalid cursor')
+    column = getattr(model, name)
+    value = cursor_value(column, cursor[0])
+    last_id = cursor[1]
+
+    if descending:
+        if value is None:
+            return or_(and_(column.is_(None), model.id < last_id),
+                       column.isnot(None))
+        return tuple_(column, model.id) < tuple_(value, last_id)
+
+    if value is None:
+        return and_(column.is_(None), model.id > last_id)
+    return or_(tuple_(column, model.id) > tuple_(value, last_id),
+               column.is_(None))
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and in_range(value)
+
+
+def cursor_value(column, value):
+    if column.type.python_type is date and isinstance(value, str):
+        return to_date('cursor', value)
+    if column.type.python_type is int and value is not None:
+        if not is_int(value):
+            raise ValueError('invalid cursor')
+        return value
+    if value is not None \
+            and not isinstance(value, column.type.python_type):
+        raise ValueError('invalid cursor')
+    return value
+
+
+'''
+Field projection
+    list and item reads select only the columns the client asked for in
+    `?fields=` (all of model.fields by default) and get plain row tuples
+    back, without building ORM entities or touching the identity map
+
+    id is always selected, the pagination cursor needs it
+'''
+
+
+def parse_fields(model, value=None):
+    if not value:
+        return model.fields
+
+    fields = ['id']
+    for name in value.split(','):
+        name = name.strip()
+        if name not in model.fields:
+            raise ValueError(f'unknown field {name}')
+        if name not in fields:
+            fields.append(name)
+    return tuple(fields)
+
+
+def select_fields(model, fields):
+    return db.session.query(*[getattr(model, name) for name in fields])
+
+
+def to_dict(fields, row):
+    return row_dict(fields)(row)
+
+
+'''
+Related rows
+    `?include=actors` on movies and `?include=movies` on actors nest the
+    cast of each row; the related rows of a whole page are loaded with
+    one extra `... WHERE movie_id IN (...)` query, like selectinload
+    does, instead of one query per row
+'''
+
+RELATIONS = {
+    (Movies, 'actors'):
+        (Actors, movie_actors.c.movie_id, movie_actors.c.actor_id),
+    (Actors, 'movies'):
+        (Movies, movie_actors.c.actor_id, movie_actors.c.movie_id)
+}
+
+
+def parse_include(model, value=None):
+    if not value:
+        return None
+    if (model, value) not in RELATIONS:
+        raise ValueError(f'can not include {value}')
+    return value
+
+
+def load_related(model, include, ids):
+    related, key, related_key = RELATIONS[(model, include)]
+    columns = [getattr(related, name) for name in related.fields]
+    rows = db.session.query(key, *columns) \
+        .select_from(movie_actors) \
+        .join(related, related.id == related_key) \
+        .filter(key.in_(ids)) \
+        .order_by(key, related.id)
+
+    result = {id: [] for id in ids}
+    to_related = row_dict(related.fields)
+    for row in rows:
+        result[row[0]].append(to_related(row[1:]))
+    return result
+
+
+'''
+to_dicts(model, fields, rows, include)
+    the rows of a page as {field: value} dicts, the form responses with
+    `?include=` and single items are encoded from: the related rows are
+    nested into them; the dicts are built with row_dict() (serializer.py),
+    which also says why orjson needs them
+'''
+
+
+def to_dicts(model, fields, rows, include=None):
+    items = list(map(row_dict(fields), rows))
+    if include and items:
+        related = load_related(model, include,
+                               [item['id'] for item in items])
+        for item in items:
+            item[include] = related[item['id']]
+    return items
+
+
+def list_query(model, args):
+    """Returns the filtered query of a list endpoint,
+    the fields to send and the sort order
+    """
+    fields = parse_fields(model, args.get('fields'))
+    sort = parse_sort(model, args.get('sort'))
+
+    # the sort column is needed for the cursor, when it wasn't asked for
+    # it is selected last so to_dict leaves it out
+    columns = fields if sort[0] in fields else fields + (sort[0],)
+    query = apply_filters(select_fields(model, columns), model, args)
+    return query, fields, sort
+
+
+'''
+paginate(query, model, sort, args)
+    applies the sort and the page requested in args to query
+
+    keyset mode (default): `limit` and an opaque `after` cursor,
+        the query seeks past the sort value and id of the last row of
+        the previous page, so each page is an index range scan however
+        deep the client pages
+    offset mode: `limit` and `page`, kept for clients that need page
+        numbers
+
+    limit defaults to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE,
+    settings of the app's config (settings.py)
+
+    returns the rows and a dict with the keys to add to the response,
+    `next` (keyset) or `page`/`next_page` (offset); they are None on the
+    last page
+'''
+
+
+def page_size(args):
+    config = current_app.config
+    return min(positive_int(args, 'limit', config['DEFAULT_PAGE_SIZE']),
+               config['MAX_PAGE_SIZE'])
+
+
+def paginate(query, model, sort, args):
+    limit = page_size(args)
+    page = positive_int(args, 'page')
+    query = query.order_by(*order_by(model, sort))
+
+    if page is not None:
+        if 'after' in args:
+            raise ValueError('after and page can not be combined')
+
+        rows = query.offset((page - 1) * limit).limit(limit + 1).all()
+        has_next = len(rows) > limit
+        return rows[:limit], {
+            'page': page,
+            'next_page': page + 1 if has_next else None
+        }
+
+    if 'after' in args:
+        query = query.filter(seek(model, sort, decode_cursor(args['after'])))
+
+    rows = query.limit(limit + 1).all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    return rows, {
+        'next': encode_cursor(cursor(rows[-1], sort)) if has_next else None
+    }
+
+
+def cursor(row, sort):
+    name = sort[0]
+    if name == 'id':
+        return [row.id]
+
+    value = getattr(row, name)
+    if isinstance(value, date):
+        value = value.isoformat()
+    return [value, row.id]
+
+
+'''
+stream(query, model, sort)
+    yields every row of query in sort order, in lists of batch_size rows
+    (STREAM_BATCH_SIZE by default)
+
+    rows are read through a server-side cursor (yield_per), so only one
+    batch is held in memory whatever the size of the table
+'''
+
+
+def stream(query, model, sort, batch_size=None):
+    batch_size = batch_size or current_app.config['STREAM_BATCH_SIZE']
+    query = query.order_by(*order_by(model, sort))
+    batch = []
+    for row in query.yield_per(batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
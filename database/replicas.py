@@ -0,0 +1,204 @@
+import hashlib
+import hmac
+import itertools
+import math
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context, has_request_context, \
+    request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+
+'''
+Read replicas
+    with DATABASE_REPLICA_URLS set (comma separated), the queries of
+    GET and HEAD requests go to a replica, everything else to the
+    primary (DATABASE_URL)
+
+    - a request reads from one replica from start to end, picked by
+      DATABASE_REPLICA_POLICY: round_robin (default) or
+      least_connections (fewest connections in use)
+    - read-your-writes: after a client writes, its reads stay on the
+      primary for DATABASE_REPLICA_STICKY_SECONDS (default 5), longer
+      than the replicas lag behind
+
+      the client carries the time it reads from the primary until in
+      a cookie (STICKY_COOKIE) set on the response of the write, so any
+      worker, on any host, serving its next read honours it; the value
+      is signed with the router's secret, SECRET_KEY when it is set and
+      else a random key of the process (shared by the workers a
+      preloaded gunicorn master forks), and is a wall clock time, the
+      hosts' clocks have to agree to within a fraction of the sticky
+      time; a client that doesn't send cookies back reads from the
+      replicas right after its writes
+
+    every app has a router (and replica engines) of its own, set up by
+    setup_db in app.extensions['replica_router']; the session and
+    db.router use the router of the current app
+'''
+
+READ_METHODS = ('GET', 'HEAD')
+STICKY_COOKIE = 'read_primary_until'
+
+
+class ReplicaRouter:
+    def __init__(self, policy='round_robin', sticky_seconds=5, secret=None):
+        if policy not in ('round_robin', 'least_connections'):
+            raise ValueError(f'unknown DATABASE_REPLICA_POLICY {policy}')
+        self.policy = policy
+        self.sticky_seconds = sticky_seconds
+        self.secret = secret or os.urandom(32)
+
+        self._urls = []
+        self._options = None
+        self._engines = []
+        self._in_use = {}
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def configure(self, urls, options=None, secret=None):
+        """Replaces the replicas with urls, options(url) returns the
+        create_engine() options of a url; the engines are created when
+        they are first used
+        """
+        self.dispose()
+        with self._lock:
+            self._urls = list(urls)
+            self._options = options
+            self._engines = None if self._urls else []
+            self._in_use = {}
+            if secret:
+                self.secret = secret.encode() if isinstance(secret, str) \
+                    else secret
+
+    @property
+    def engines(self):
+        if self._engines is None:
+            with self._lock:
+                if self._engines is None:
+                    self._engines = [self._create_engine(url)
+                                     for url in self._urls]
+        return self._engines
+
+    def _create_engine(self, url):
+        engine = create_engine(
+            url, **(self._options(url) if self._options else {}))
+        self._in_use[engine] = 0
+        event.listen(engine, 'checkout', self._checkout(engine))
+        event.listen(engine, 'checkin', self._checkin(engine))
+        return engine
+
+    def dispose(self):
+        """Closes the pooled connections of the replicas, e.g. those a
+        forked worker inherited, new ones are opened on demand
+        """
+        for engine in self._engines or ():
+            engine.dispose()
+
+    def _checkout(self, engine):
+        def checkout(dbapi_connection, connection_record, proxy):
+            with self._lock:
+                self._in_use[engine] += 1
+        return checkout
+
+    def _checkin(self, engine):
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self._in_use[engine] -= 1
+        return checkin
+
+    def read_engine(self):
+        """Returns the replica of the current request, None when the
+        request has to use the primary
+        """
+        if not self._urls or not has_request_context():
+            return None
+        if 'read_engine' not in g:
+            g.read_engine = self._pick() \
+                if request.method in READ_METHODS \
+                and not self._is_sticky() else None
+        return g.read_engine
+
+    def _pick(self):
+        if self.policy == 'least_connections':
+            with self._lock:
+                return min(self.engines, key=self._in_use.get)
+        return self.engines[next(self._next) % len(self.engines)]
+
+    def _sign(self, value):
+        return hmac.new(self.secret, value.encode(),
+                        hashlib.sha256).hexdigest()
+
+    def _is_sticky(self):
+        value, _, signature = request.cookies.get(STICKY_COOKIE, '') \
+            .partition('.')
+        if not signature \
+                or not hmac.compare_digest(signature, self._sign(value)):
+            return False
+        try:
+            return int(value) > time.time()
+        except ValueError:
+            return False
+
+    def wrote(self):
+        """Keeps the reads of the current client on the primary, see
+        set_sticky_cookie()
+        """
+        if self._urls and has_request_context():
+            g.read_primary_until = math.ceil(time.time() +
+                                             self.sticky_seconds)
+
+    def set_sticky_cookie(self, response):
+        """An after_request hook, sends the client the time it reads
+        from the primary until, when the request wrote
+        """
+        until = g.pop('read_primary_until', None)
+        if until is not None:
+            value = str(until)
+            response.set_cookie(STICKY_COOKIE,
+                                value + '.' + self._sign(value),
+                                max_age=math.ceil(self.sticky_seconds),
+                                httponly=True, samesite='Lax')
+        return response
+
+    def stats(self):
+        return {
+            'replicas': len(self._urls),
+            'policy': self.policy,
+            'in_use': [self._in_use[engine]
+                       for engine in self._engines or ()]
+        }
+
+
+def app_router(app):
+    """The ReplicaRouter of app, None before setup_db"""
+    return app.extensions.get('replica_router')
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # flushes write, they always go to the primary
+        if not self._flushing and has_app_context():
+            router = app_router(current_app)
+            engine = router.read_engine() if router is not None else None
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose session sends the reads of an app to the
+    replicas of its router
+    """
+
+    def get_router(self, app=None):
+        """The ReplicaRouter of app, the current app by default"""
+        return app_router(self.get_app(app))
+
+    @property
+    def router(self):
+        return self.get_router()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
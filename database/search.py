@@ -0,0 +1,78 @@
+import re
+from sqlalchemy import func, literal, literal_column, select, table, \
+    column, union_all
+
+from database.models import db, Movies, Actors
+
+'''
+search(q, kinds, limit, offset)
+    ranked full-text search over movie titles and actor names, served
+    by the indexes set up in database/models.py (Search indexes)
+
+    every word of q must match the start of a word of the title or name,
+    `king ro` finds "the lion king roars"; the best matches come first
+
+    kinds picks what to search, ('movie', 'actor') for both
+    returns a list of {'type', 'id', 'title' or 'name'} dicts
+'''
+
+MAX_TERMS = 8
+
+SEARCHES = {
+    'movie': (Movies, 'title'),
+    'actor': (Actors, 'name')
+}
+
+
+def parse_terms(q):
+    terms = re.findall(r'\w+', (q or '').lower())[:MAX_TERMS]
+    if not terms:
+        raise ValueError('q must contain a word')
+    return terms
+
+
+def postgresql_search(kind, terms):
+    model, name = SEARCHES[kind]
+    text = getattr(model, name)
+    # the expression must be the one of the GIN index to be served by it
+    vector = func.to_tsvector(literal_column("'simple'"), text)
+    query = func.to_tsquery(literal_column("'simple'"),
+                            ' & '.join(term + ':*' for term in terms))
+    return select([
+        literal(kind).label('type'),
+        model.id.label('id'),
+        text.label('text'),
+        func.ts_rank(vector, query).label('rank')
+    ]).where(vector.op('@@')(query))
+
+
+def sqlite_search(kind, terms):
+    model, name = SEARCHES[kind]
+    fts = table(model.__tablename__ + '_search', column('rowid'))
+    match = ' '.join(f'"{term}"*' for term in terms)
+    return select([
+        literal(kind).label('type'),
+        model.id.label('id'),
+        getattr(model, name).label('text'),
+        # bm25() is lower for better matches
+        (-func.bm25(literal_column(fts.name))).label('rank')
+    ]).select_from(fts.join(model, model.id == fts.c.rowid)) \
+        .where(literal_column(fts.name).op('MATCH')(match))
+
+
+def search(q, kinds, limit, offset=0):
+    terms = parse_terms(q)
+    searches = postgresql_search if db.engine.dialect.name == 'postgresql' \
+        else sqlite_search
+
+    results = union_all(*[searches(kind, terms) for kind in kinds]).alias()
+    rows = db.session.execute(
+        select([results])
+        .order_by(results.c.rank.desc(), results.c.type, results.c.id)
+        .limit(limit).offset(offset))
+
+    return [{
+        'type': row.type,
+        'id': row.id,
+        SEARCHES[row.type][1]: row.text
+    } for row in rows]
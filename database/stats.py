@@ -0,0 +1,64 @@
+from sqlalchemy import Integer, cast, extract, func, literal_column
+
+from database.models import db, Movies, Actors
+from database.queries import apply_filters, positive_int
+
+'''
+Statistics
+    counts computed with GROUP BY in the database, so a dashboard gets
+    a few numbers instead of every row; the filters of the list endpoints
+    (database/queries.py) narrow down the rows that are counted
+
+    histograms are lists of {'from', 'count'} buckets in ascending
+    order, a bucket holds the values from `from` up to `from` + width,
+    rows without a value are counted in a bucket from None
+
+    they raise ValueError on bad client input
+'''
+
+
+def histogram(model, args, value, width):
+    # grouped by the output name, bucket, so the expression is written
+    # once and can't be mistaken for a column of the table
+    bucket = (value / width * width).label('bucket')
+    query = apply_filters(
+        db.session.query(bucket, func.count()).select_from(model),
+        model, args)
+    rows = query.group_by(literal_column('bucket')).all()
+
+    # sorted here, databases disagree on where nulls go
+    rows.sort(key=lambda row: (row[0] is not None, row[0] or 0))
+    return [{'from': row[0], 'count': row[1]} for row in rows]
+
+
+def actor_stats(args):
+    width = positive_int(args, 'age_bucket', 10)
+    total, average_age = apply_filters(
+        db.session.query(func.count(Actors.id), func.avg(Actors.age)),
+        Actors, args).one()
+    genders = apply_filters(
+        db.session.query(Actors.gender, func.count()), Actors, args) \
+        .group_by(Actors.gender).order_by(Actors.gender).all()
+
+    return {
+        'total': total,
+        'average_age': float(average_age)
+        if average_age is not None else None,
+        'by_gender': [{'gender': gender, 'count': count}
+                      for gender, count in genders],
+        'age_bucket': width,
+        'by_age': histogram(Actors, args, Actors.age, width)
+    }
+
+
+def movie_stats(args):
+    width = positive_int(args, 'year_bucket', 1)
+    total = apply_filters(
+        db.session.query(func.count(Movies.id)), Movies, args).scalar()
+    year = cast(extract('year', Movies.release_date), Integer)
+
+    return {
+        'total': total,
+        'year_bucket': width,
+        'by_year': histogram(Movies, args, year, width)
+    }
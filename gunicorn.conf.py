@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+# set before the app is created, create_app reads it (settings.py)
+temporary_metrics_dir = 'METRICS_DIR' not in os.environ
+if temporary_metrics_dir:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='metrics-')
+
+from database.models import dispose_engines  # noqa: E402
+from metrics import clear_dir  # noqa: E402
+
+'''
+gunicorn settings, read from the working directory by
+`gunicorn app:APP` (Procfile) and the benchmarks
+
+    preload_app: the master imports and creates the app once and forks
+        the workers from it, they start without importing anything and
+        share its memory copy-on-write; `kill -HUP` then restarts the
+        workers without reloading the code, deploy with a full restart
+
+    post_fork: a worker drops the pooled database connections it
+        inherited, a connection used by two processes corrupts both
+        sides, and opens its own on its first query
+
+    timeout: seconds a (sync) worker may spend on a request before it is
+        killed; IDEMPOTENCY_LOCK_TIMEOUT (database/idempotency.py) has to
+        stay well above it
+
+    METRICS_DIR: the directory where every worker keeps its metrics for
+        GET /metrics to add them up (metrics.py), a new temporary one
+        unless set; on_starting empties it, on_exit deletes the
+        temporary one
+'''
+
+preload_app = True
+timeout = 30
+metrics_dir = os.environ['METRICS_DIR']
+
+
+def on_starting(server):
+    clear_dir(metrics_dir)
+
+
+def on_exit(server):
+    if temporary_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        dispose_engines(server.app.wsgi())
@@ -1,16 +1,47 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
-from database.models import setup_db
+from app import create_app
+from database.models import db
+from database.idempotency import sweep
+from auth.auth import registered_permissions, mint_token as mint, ROLES
 
-db = setup_db(APP)
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
+def create_cli_app():
+    # Flask-Migrate (and alembic with it) is only needed by the db
+    # commands, the app itself doesn't load it
+    app = create_app()
+    Migrate(app, db)
+    return app
+
+
+manager = Manager(create_cli_app)
 
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def permissions():
+    """Lists every permission enforced by the API"""
+    for permission in registered_permissions():
+        print(permission)
+
+
+@manager.command
+def sweep_idempotency_keys():
+    """Deletes the expired idempotency keys"""
+    print(f'{sweep()} keys deleted')
+
+
+@manager.option('-r', '--role', default='executive_producer',
+                choices=sorted(ROLES))
+@manager.option('-s', '--subject', default='local|user')
+@manager.option('-e', '--expires-in', dest='expires_in', type=int,
+                default=3600, help='seconds')
+def mint_token(role, subject, expires_in):
+    """Prints a token for role, signed by the AUTH_KEYS=local:... key"""
+    print(mint(role, subject=subject, expires_in=expires_in))
+
+
 if __name__ == '__main__':
     manager.run()
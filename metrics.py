@@ -0,0 +1,403 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from flask import g, current_app, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+'''
+Request metrics
+    every request is timed by phase, the phases are added up in
+    g.request_timer while the request runs
+        auth: @requires_auth, token header, decoding and permission check
+        jwks: the JWKS key lookup inside auth (a fetch on a cache miss)
+        db: the SQL statements, timed by SQLAlchemy engine events on
+            every engine (primary and replicas), which also count them;
+            this is the only before/after_cursor_execute listener pair,
+            the SQL profiler (database/profiler.py) gets every statement
+            from it through on_statement() and budgets the count
+        serialize: encoding the JSON of the read endpoints
+    plus the total, up to the response leaving the view and its handlers
+
+    setup_metrics(app) hooks the timer into the app; each response gets
+        - a Server-Timing header with the phases of the request
+          (SERVER_TIMING=off leaves it out)
+        - its duration, phases, statement count and body size added to
+          the histograms of its route, rendered by render() in the
+          Prometheus text format for GET /metrics
+
+    METRICS=off turns all of it off; the settings are read from the
+    app's config, or the environment (settings.py), when the app is set
+    up
+
+    the series are kept per process; with METRICS_DIR set, a directory
+    shared by the processes (gunicorn.conf.py sets one up for the
+    workers), every process writes them to a file of its own there,
+    every FLUSH_INTERVAL seconds once it serves requests and when it
+    exits, and render() adds up the files of all the processes, so whichever
+    worker answers a scrape reports the requests of every worker; the
+    files of workers that exited are kept so the totals never go down,
+    the directory is emptied when gunicorn starts
+'''
+
+FLUSH_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+PHASES = ('auth', 'jwks', 'db', 'serialize')
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def label_text(names, values, extra=''):
+    labels = [f'{name}="{escape(value)}"'
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(values), count]
+                    for values, count in self._series.items()]
+
+    @staticmethod
+    def merge(series, snapshot):
+        for values, count in snapshot:
+            values = tuple(values)
+            series[values] = series.get(values, 0) + count
+
+    def render(self, series=None):
+        """The lines of the series, those of this process by default"""
+        if series is None:
+            with self._lock:
+                series = dict(self._series)
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} counter']
+        for values, count in sorted(series.items()):
+            lines.append(
+                f'{self.name}{label_text(self.labels, values)} {count}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = \
+                    [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(values), list(counts), total]
+                    for values, (counts, total) in self._series.items()]
+
+    @staticmethod
+    def merge(series, snapshot):
+        for values, counts, total in snapshot:
+            values = tuple(values)
+            merged = series.get(values)
+            if merged is None:
+                series[values] = [list(counts), total]
+            elif len(merged[0]) == len(counts):
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+
+    def render(self, series=None):
+        """The lines of the series, those of this process by default"""
+        if series is None:
+            with self._lock:
+                series = {values: (list(counts), total) for values,
+                          (counts, total) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for values, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = label_text(self.labels, values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = label_text(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+REQUESTS = Counter(
+    'http_requests_total', 'Requests served.',
+    ('method', 'route', 'status'))
+DURATION = Histogram(
+    'http_request_duration_seconds', 'Time spent serving a request.',
+    ('method', 'route'), LATENCY_BUCKETS)
+PHASE_DURATION = Histogram(
+    'http_request_phase_seconds',
+    'Time spent in a phase (auth, jwks, db, serialize) of a request.',
+    ('route', 'phase'), LATENCY_BUCKETS)
+QUERIES = Histogram(
+    'http_request_sql_statements', 'SQL statements run by a request.',
+    ('route',), QUERY_BUCKETS)
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes',
+    'Size of a response body, streamed responses are left out.',
+    ('route',), SIZE_BUCKETS)
+
+METRICS = (REQUESTS, DURATION, PHASE_DURATION, QUERIES, RESPONSE_SIZE)
+
+
+class RequestTimer:
+    __slots__ = ('start', 'phases', 'queries')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+def current_timer():
+    if not has_request_context():
+        return None
+    return g.get('request_timer')
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the block to phase of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = current_timer()
+        if timer is not None:
+            timer.add(phase, time.perf_counter() - start)
+
+
+_statement_hooks = []
+
+
+def on_statement(hook):
+    """Calls hook(conn, statement, parameters, executemany, seconds)
+    after every statement, once however often it is registered
+    """
+    if hook not in _statement_hooks:
+        _statement_hooks.append(hook)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - conn.info['query_started']
+    timer = current_timer()
+    if timer is not None:
+        timer.add('db', elapsed)
+        timer.queries += 1
+    for hook in _statement_hooks:
+        hook(conn, statement, parameters, executemany, elapsed)
+
+
+def start_timer():
+    g.request_timer = RequestTimer()
+
+
+def record(response):
+    timer = g.pop('request_timer', None)
+    if timer is None:
+        return response
+    total = time.perf_counter() - timer.start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    REQUESTS.inc(request.method, route, str(response.status_code))
+    DURATION.observe(total, request.method, route)
+    for phase, seconds in timer.phases.items():
+        PHASE_DURATION.observe(seconds, route, phase)
+    QUERIES.observe(timer.queries, route)
+    # a streamed body is only produced after this, its size is unknown
+    if not response.is_streamed:
+        RESPONSE_SIZE.observe(response.calculate_content_length(), route)
+    metrics_dir = current_app.config['METRICS_DIR']
+    if metrics_dir and _flushed[1] != os.getpid():
+        start_flushing(metrics_dir)
+
+    if current_app.config['SERVER_TIMING'] != 'off':
+        timings = [f'{phase};dur={timer.phases[phase] * 1000:.2f}'
+                   for phase in PHASES if phase in timer.phases]
+        if timer.queries:
+            timings.append(f'sql;desc="{timer.queries} statements"')
+        timings.append(f'total;dur={total * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+# the file of this process, named when it first flushes: a forked
+# worker gets a name of its own, a restarted one doesn't reuse the file
+# of the worker whose pid it got; the pid flushing in the background;
+# and what was last written
+_flushed = [None, None, None]
+_flush_lock = threading.Lock()
+
+
+def process_file(metrics_dir):
+    pid = os.getpid()
+    name = _flushed[0]
+    if name is None or not name.startswith(f'metrics-{pid}-'):
+        name = _flushed[0] = f'metrics-{pid}-{uuid.uuid4().hex[:8]}.json'
+    return os.path.join(metrics_dir, name)
+
+
+def flush(metrics_dir):
+    """Writes the series of this process to its file in metrics_dir,
+    unless they haven't changed since the last time
+    """
+    with _flush_lock:
+        path = process_file(metrics_dir)
+        snapshot = json.dumps(
+            {metric.name: metric.snapshot() for metric in METRICS})
+        if snapshot == _flushed[2] and os.path.exists(path):
+            return
+        fd, temporary = tempfile.mkstemp(dir=metrics_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(snapshot)
+        os.replace(temporary, path)
+        _flushed[2] = snapshot
+
+
+def start_flushing(metrics_dir):
+    """Flushes every FLUSH_INTERVAL seconds in a thread of this process,
+    started on its first request (a thread doesn't survive a fork)
+    """
+    with _flush_lock:
+        if _flushed[1] == os.getpid():
+            return
+        _flushed[1] = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                flush(metrics_dir)
+            except OSError:
+                logger.warning('Unable to write metrics to %s', metrics_dir,
+                               exc_info=True)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def flush_at_exit(metrics_dir):
+    if _flushed[1] != os.getpid():
+        # served no requests, the gunicorn master for instance
+        return
+    try:
+        flush(metrics_dir)
+    except OSError:
+        # the directory went with the gunicorn master that made it
+        pass
+
+
+def merged_series(metrics_dir):
+    """The series of every process with a file in metrics_dir, added up
+    """
+    series = {metric.name: {} for metric in METRICS}
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics-*.json')):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric in METRICS:
+            metric.merge(series[metric.name], snapshot.get(metric.name, []))
+    return series
+
+
+def render(metrics_dir=None):
+    """The metrics in the Prometheus text exposition format, of every
+    process flushing to metrics_dir when it is set
+    """
+    series = {}
+    if metrics_dir:
+        flush(metrics_dir)
+        series = merged_series(metrics_dir)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(series.get(metric.name)))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_dir(directory):
+    """Deletes the metrics files of earlier runs in directory"""
+    for path in glob.glob(os.path.join(directory, 'metrics-*')):
+        os.remove(path)
+
+
+def install():
+    """Attaches the statement timer to every engine, once"""
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+_exit_flushes = set()
+
+
+def setup_metrics(app):
+    if app.config['METRICS'] == 'off' \
+            or record in app.after_request_funcs.get(None, ()):
+        return
+    install()
+    if start_timer not in app.before_request_funcs.get(None, ()):
+        app.before_request(start_timer)
+    app.after_request(record)
+
+    metrics_dir = app.config['METRICS_DIR']
+    if metrics_dir and metrics_dir not in _exit_flushes:
+        _exit_flushes.add(metrics_dir)
+        atexit.register(flush_at_exit, metrics_dir)
@@ -0,0 +1,36 @@
+"""add filter and sort indexes to movies and actors
+
+Revision ID: 3c9b2a71f0d4
+Revises: e4d720de3ea1
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9b2a71f0d4'
+down_revision = 'e4d720de3ea1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'])
+    op.create_index('ix_movies_title_pattern', 'movies', ['title'],
+                    postgresql_ops={'title': 'varchar_pattern_ops'})
+    op.create_index('ix_actors_gender', 'actors', ['gender'])
+    op.create_index('ix_actors_age_id', 'actors', ['age', 'id'])
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+    op.create_index('ix_actors_name_pattern', 'actors', ['name'],
+                    postgresql_ops={'name': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_pattern', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_gender', table_name='actors')
+    op.drop_index('ix_movies_title_pattern', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
@@ -0,0 +1,35 @@
+"""add the movie_actors cast table
+
+Revision ID: 5a7e3c19d2b8
+Revises: 8f41d06b7c2e
+Create Date: 2026-10-18 13:20:05.118342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7e3c19d2b8'
+down_revision = '8f41d06b7c2e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_actors',
+                    sa.Column('movie_id', sa.Integer(), nullable=False),
+                    sa.Column('actor_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                            ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+                    )
+    op.create_index('ix_movie_actors_actor_id', 'movie_actors',
+                    ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_actors_actor_id', table_name='movie_actors')
+    op.drop_table('movie_actors')
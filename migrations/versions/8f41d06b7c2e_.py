@@ -0,0 +1,78 @@
+"""store movies.release_date as a DATE
+
+Revision ID: 8f41d06b7c2e
+Revises: 3c9b2a71f0d4
+Create Date: 2026-10-18 11:02:47.835120
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f41d06b7c2e'
+down_revision = '3c9b2a71f0d4'
+branch_labels = None
+depends_on = None
+
+# release dates were stored as the client sent them, DD-MM-YYYY
+# (25-10-2019) and sometimes ISO 8601 (2019-10-25); anything else is
+# not a date and becomes NULL
+DATE_FORMATS = ('%d-%m-%Y', '%Y-%m-%d')
+
+movies = sa.table('movies',
+                  sa.column('id', sa.Integer),
+                  sa.column('release_date', sa.String),
+                  sa.column('release_date_new', sa.Date))
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except (AttributeError, ValueError):
+            pass
+    return None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("""
+            ALTER TABLE movies ALTER COLUMN release_date TYPE DATE USING
+            CASE
+                WHEN release_date ~ '^\\d{1,2}-\\d{1,2}-\\d{4}$'
+                    THEN to_date(release_date, 'DD-MM-YYYY')
+                WHEN release_date ~ '^\\d{4}-\\d{1,2}-\\d{1,2}$'
+                    THEN to_date(release_date, 'YYYY-MM-DD')
+            END
+        """)
+    else:
+        # no ALTER ... USING, backfill a new column row by row
+        op.add_column('movies', sa.Column('release_date_new', sa.Date()))
+        connection = op.get_bind()
+        rows = connection.execute(
+            sa.select([movies.c.id, movies.c.release_date])).fetchall()
+        for movie_id, release_date in rows:
+            connection.execute(
+                movies.update()
+                .where(movies.c.id == movie_id)
+                .values(release_date_new=parse_date(release_date)))
+
+        with op.batch_alter_table('movies') as batch_op:
+            batch_op.drop_column('release_date')
+            batch_op.alter_column('release_date_new',
+                                  new_column_name='release_date')
+
+    op.create_index('ix_movies_release_date_id', 'movies',
+                    ['release_date', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.alter_column(
+            'release_date',
+            type_=sa.String(),
+            postgresql_using="to_char(release_date, 'DD-MM-YYYY')")
@@ -0,0 +1,25 @@
+"""record the owner of an idempotency key
+
+Revision ID: a3f9c2e71b56
+Revises: e8f0b2d64a19
+Create Date: 2026-10-18 21:04:12.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f9c2e71b56'
+down_revision = 'e8f0b2d64a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('idempotency_keys',
+                  sa.Column('owner', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('idempotency_keys', 'owner')
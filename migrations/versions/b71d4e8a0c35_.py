@@ -0,0 +1,53 @@
+"""add updated_at columns and the table_versions table
+
+Revision ID: b71d4e8a0c35
+Revises: 5a7e3c19d2b8
+Create Date: 2026-10-18 14:02:41.507213
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d4e8a0c35'
+down_revision = '5a7e3c19d2b8'
+branch_labels = None
+depends_on = None
+
+VERSIONED_TABLES = ('movies', 'actors', 'movie_actors')
+
+
+def upgrade():
+    # existing rows get the time of the migration, new rows get theirs
+    # from the application (database/models.py); SQLite can't add a
+    # column with a CURRENT_TIMESTAMP default to a table with rows, so
+    # the column is added nullable, filled, then made NOT NULL (batch
+    # mode copies the table on SQLite)
+    for table in ('movies', 'actors'):
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                       nullable=True))
+        op.execute(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', existing_type=sa.DateTime(),
+                                  nullable=False)
+
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 0, 'updated_at': datetime.utcnow()}
+        for name in VERSIONED_TABLES
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
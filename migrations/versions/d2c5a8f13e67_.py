@@ -0,0 +1,55 @@
+"""add the search indexes of movie titles and actor names
+
+Revision ID: d2c5a8f13e67
+Revises: b71d4e8a0c35
+Create Date: 2026-10-18 14:48:12.730584
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2c5a8f13e67'
+down_revision = 'b71d4e8a0c35'
+branch_labels = None
+depends_on = None
+
+SEARCHABLE = (('movies', 'title'), ('actors', 'name'))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHABLE:
+        if dialect == 'postgresql':
+            op.execute(f'CREATE INDEX ix_{table}_{column}_search ON {table} '
+                       f"USING gin (to_tsvector('simple', {column}))")
+            continue
+
+        fts = f'{table}_search'
+        delete = (f"INSERT INTO {fts}({fts}, rowid, {column}) "
+                  f"VALUES ('delete', old.id, old.{column});")
+        insert = (f'INSERT INTO {fts}(rowid, {column}) '
+                  f'VALUES (new.id, new.{column});')
+        op.execute(f'CREATE VIRTUAL TABLE {fts} USING fts5('
+                   f"{column}, content='{table}', content_rowid='id')")
+        op.execute(f'CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} '
+                   f'BEGIN {insert} END')
+        op.execute(f'CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} '
+                   f'BEGIN {delete} END')
+        op.execute(f'CREATE TRIGGER {fts}_update '
+                   f'AFTER UPDATE OF {column} ON {table} '
+                   f'BEGIN {delete} {insert} END')
+        # index the rows that are already there
+        op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHABLE:
+        if dialect == 'postgresql':
+            op.drop_index(f'ix_{table}_{column}_search', table_name=table)
+            continue
+
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f'DROP TRIGGER {table}_search_{trigger}')
+        op.execute(f'DROP TABLE {table}_search')
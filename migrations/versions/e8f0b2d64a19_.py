@@ -0,0 +1,37 @@
+"""add the idempotency_keys table
+
+Revision ID: e8f0b2d64a19
+Revises: d2c5a8f13e67
+Create Date: 2026-10-18 15:31:57.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8f0b2d64a19'
+down_revision = 'd2c5a8f13e67'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+                    sa.Column('caller', sa.String(), nullable=False),
+                    sa.Column('key', sa.String(), nullable=False),
+                    sa.Column('request_hash', sa.String(), nullable=False),
+                    sa.Column('status', sa.Integer(), nullable=True),
+                    sa.Column('mimetype', sa.String(), nullable=True),
+                    sa.Column('body', sa.LargeBinary(), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('caller', 'key')
+                    )
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys',
+                    ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_created_at',
+                  table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
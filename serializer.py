@@ -0,0 +1,146 @@
+import json
+from datetime import date
+from functools import lru_cache
+from json.encoder import encode_basestring
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON serializer
+    compact JSON (no indentation, no key sorting) for the API responses,
+    with orjson when it is installed and the stdlib json module otherwise;
+    JSON_SERIALIZER=json forces the stdlib; setup_serializer(app) (called
+    by create_app) picks the serializer of an app, current_serializer()
+    returns it
+
+    dates are sent as ISO 8601 (2019-10-25) by both
+
+    rows(fields, rows) encodes query rows (tuples) as a JSON array of
+    objects: with the stdlib through a per-row template, without building
+    a dict per row; with orjson through one dumps() call over a dict per
+    row, built by row_dict(fields)
+
+    orjson only writes a JSON object from a dict (or a dataclass), and
+    every way of writing the rows without one measured slower: a dumps()
+    per value spliced into a template ~1.3 us/row, dataclasses ~2.1,
+    against ~0.55 for the dicts of row_dict() and ~1.0 for
+    dict(zip(fields, row)) (python -m bench.serialization)
+
+    json_response(payload) sends payload; values wrapped in Encoded are
+    already JSON and are copied into the body as they are
+'''
+
+
+class Encoded(bytes):
+    """JSON that is already encoded"""
+
+
+@lru_cache(maxsize=64)
+def row_dict(fields):
+    """Returns a function turning a row tuple into a {field: value} dict,
+    a dict display compiled for fields, about twice as fast as
+    dict(zip(fields, row)); columns after fields are left out
+    """
+    source = 'lambda row: {' + ', '.join(
+        f'{name!r}: row[{index}]' for index, name in enumerate(fields)) + '}'
+    return eval(source, {})
+
+
+class Serializer:
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend not in ('orjson', 'json'):
+            raise ValueError(f'unknown JSON_SERIALIZER {backend}')
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('JSON_SERIALIZER=orjson needs orjson installed')
+
+        self.backend = backend
+        self._encoder = json.JSONEncoder(
+            separators=(',', ':'), ensure_ascii=False, default=self._default)
+        # the encoders of the column types, anything else goes through
+        # the json encoder
+        self._values = {
+            type(None): lambda value: 'null',
+            str: encode_basestring,
+            int: int.__repr__,
+            date: lambda value: '"' + value.isoformat() + '"'
+        }
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        raise TypeError(f'{type(o).__name__} is not JSON serializable')
+
+    def dumps(self, obj):
+        if self.backend == 'orjson':
+            return orjson.dumps(obj)
+        return self._encoder.encode(obj).encode()
+
+    def _encode_rows(self, fields, rows, template):
+        # rows may carry extra columns after fields, the sort column of a
+        # page for instance, the slice leaves them out
+        size = len(fields)
+        get = self._values.get
+        encode = self._encoder.encode
+        if rows and len(rows[0]) > size:
+            rows = [row[:size] for row in rows]
+        return [template % tuple([get(type(value), encode)(value)
+                                  for value in row])
+                for row in rows]
+
+    @staticmethod
+    def _template(fields):
+        return '{' + ','.join(encode_basestring(name) + ':%s'
+                              for name in fields) + '}'
+
+    def rows(self, fields, rows):
+        """Returns rows as a JSON array of {field: value} objects"""
+        if self.backend == 'orjson':
+            return Encoded(orjson.dumps(list(map(row_dict(fields), rows))))
+
+        template = self._template(fields)
+        return Encoded(('[' + ','.join(
+            self._encode_rows(fields, rows, template)) + ']').encode())
+
+    def lines(self, fields, rows):
+        """Returns rows as JSON objects, one per line (NDJSON)"""
+        if self.backend == 'orjson':
+            to_dict = row_dict(fields)
+            return b''.join([orjson.dumps(to_dict(row)) + b'\n'
+                             for row in rows])
+
+        template = self._template(fields) + '\n'
+        return ''.join(self._encode_rows(fields, rows, template)).encode()
+
+    def payload(self, payload):
+        """Returns payload as JSON, copying its Encoded values as they are
+        """
+        encoded = {key: value for key, value in payload.items()
+                   if isinstance(value, Encoded)}
+        if not encoded:
+            return self.dumps(payload)
+
+        body = self.dumps({key: value for key, value in payload.items()
+                           if key not in encoded})
+        parts = [self.dumps(key) + b':' + value
+                 for key, value in encoded.items()]
+        if body != b'{}':
+            parts.insert(0, body[1:-1])
+        return b'{' + b','.join(parts) + b'}'
+
+
+def setup_serializer(app):
+    """Gives app the Serializer of JSON_SERIALIZER, raises ValueError
+    when it is unknown or not installed
+    """
+    app.extensions['serializer'] = Serializer(app.config['JSON_SERIALIZER'])
+
+
+def current_serializer():
+    return current_app.extensions['serializer']
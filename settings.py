@@ -0,0 +1,57 @@
+import os
+
+'''
+App settings
+    the tunables below are read from the app's config, and from the
+    environment when the config doesn't set them; create_app() fills
+    them into app.config with load_settings() before the setup_* calls,
+    which build the per-app objects from app.config (the response
+    cache, the serializer, the profiler and metrics settings), and the
+    request code reads them from current_app.config
+
+    so nothing is read from the environment on import, two apps in one
+    process each keep their own, and an invalid value is a ValueError
+    from create_app()
+
+    the database and auth settings have readers of their own, see
+    setup_db (database/models.py) and auth_settings (auth/auth.py)
+'''
+
+# name: (type, default); None for a setting that is off unless set
+SETTINGS = {
+    'DEFAULT_PAGE_SIZE': (int, 50),
+    'MAX_PAGE_SIZE': (int, 500),
+    'STREAM_BATCH_SIZE': (int, 1000),
+    'BULK_MAX_ITEMS': (int, 10000),
+    'BULK_CHUNK_SIZE': (int, 1000),
+    'IDEMPOTENCY_KEY_TTL': (int, 86400),
+    'IDEMPOTENCY_LOCK_TIMEOUT': (int, 600),
+    'IDEMPOTENCY_WAIT': (float, 10.0),
+    'RESPONSE_CACHE': (str, 'memory'),
+    'RESPONSE_CACHE_SIZE': (int, 512),
+    'JSON_SERIALIZER': (str, None),
+    'SLOW_QUERY_MS': (float, None),
+    'SLOW_QUERY_EXPLAIN': (str, 'on'),
+    'N_PLUS_ONE_THRESHOLD': (int, None),
+    'QUERY_BUDGETS': (str, 'off'),
+    'METRICS': (str, 'on'),
+    'SERVER_TIMING': (str, 'on'),
+    'METRICS_DIR': (str, None)
+}
+
+
+def load_settings(config, environ=os.environ):
+    """Sets the SETTINGS in config, from environ where config doesn't set
+    them, raises ValueError if one has the wrong type
+    """
+    for name, (kind, default) in SETTINGS.items():
+        value = config.get(name)
+        if value is None:
+            value = environ.get(name) or default
+        if value is not None:
+            try:
+                value = kind(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{name} must be of type {kind.__name__}')
+        config[name] = value
+    return config
@@ -1,15 +1,55 @@
+import atexit
+import hashlib
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
+from datetime import datetime, timedelta
+from unittest import mock
+from pathlib import Path
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwt
+from sqlalchemy import event
 
-from app import APP
-from database.models import setup_db, Movies, Actors, create_drop_tables
+# without a DATABASE_URL the tests get a SQLite file of their own, so
+# they need no server and several runs can go in parallel
+if 'DATABASE_URL' not in os.environ:
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    os.environ['DATABASE_URL'] = \
+        'sqlite:///' + os.path.join(directory, 'test.sqlite')
+# no Auth0 settings needed, see auth.check_settings
+os.environ.setdefault('AUTH_KEYS', 'local')
+# an endpoint running more SQL statements than its @query_budget fails
+os.environ.setdefault('QUERY_BUDGETS', 'raise')
+
+from app import APP, create_app  # noqa: E402
+from auth import auth  # noqa: E402
+from auth.keys import LocalKeyPair  # noqa: E402
+from database.models import setup_db, Movies, Actors, \
+    create_drop_tables  # noqa: E402
+from database import models, idempotency  # noqa: E402
+from database.queries import encode_cursor  # noqa: E402
+
+# the tokens are signed by a key pair of this process, not by Auth0
+KEYS = LocalKeyPair(bits=1024)
+auth.use_key_provider(KEYS, APP)
+with APP.app_context():
+    EXECUTIVE_PRODUCER = auth.mint_token('executive_producer',
+                                         subject='local|producer')
+    CASTING_ASSISTANT = auth.mint_token('casting_assistant',
+                                        subject='local|assistant')
 
 
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
-    create_drop_tables()
+    with APP.app_context():
+        create_drop_tables()
 
     def setUp(self):
         """Define test variables and initialize app."""
@@ -24,8 +64,8 @@ class CastingAgencyTestCase(unittest.TestCase):
             # create all tables
             self.db.create_all()
 
-        self.executive_producer = os.environ['EXECUTIVE_PRODUCER']
-        self.casting_assistant = os.environ['CASTING_ASSISTANT']
+        self.executive_producer = EXECUTIVE_PRODUCER
+        self.casting_assistant = CASTING_ASSISTANT
 
         self.new_movie = {
             'title': 'kingdom',
@@ -47,8 +87,95 @@ class CastingAgencyTestCase(unittest.TestCase):
             'Content-Type': 'application/json',
             'Authorization': 'bearer ' + token}
 
+    @contextmanager
+    def count_queries(self):
+        """Collects the SQL statements run inside the block"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = models.db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
     # Test endpoints for success and error behavior
 
+    def test_health(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database'], 'ok')
+        self.assertIn('pool', data)
+
+    def test_server_timing(self):
+        res = self.client().get(
+            '/movies', headers=self.header(self.casting_assistant))
+        timing = res.headers['Server-Timing']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('auth;dur=', timing)
+        self.assertIn('db;dur=', timing)
+        self.assertIn('statements"', timing)
+        self.assertTrue(timing.endswith(tuple('0123456789')))
+
+    def test_metrics(self):
+        self.client().get('/movies',
+                          headers=self.header(self.casting_assistant))
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('http_requests_total{method="GET",route="/movies",'
+                      'status="200"}', text)
+        self.assertIn('http_request_phase_seconds_count{route="/movies",'
+                      'phase="serialize"}', text)
+        self.assertIn('http_request_sql_statements_count{route="/movies"}',
+                      text)
+        self.assertIn('http_response_size_bytes_sum{route="/movies"}', text)
+
+    def test_get_movies_from_replica_until_a_write(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        router = models.db.get_router(self.app)
+        router.configure(['sqlite:///' + path])
+        try:
+            replica = router.engines[0]
+            models.db.metadata.create_all(bind=replica)
+            replica.execute(Movies.__table__.insert().values(
+                title='only on the replica', updated_at=datetime.utcnow()))
+            headers = self.header(self.executive_producer)
+            # a client keeping its cookies, like a browser
+            client = self.client()
+
+            res = client.get('/movies?title_prefix=only+on+the',
+                             headers=headers)
+            self.assertEqual(len(json.loads(res.data)['movies']), 1)
+
+            # read-your-writes: the next reads go to the primary
+            res = client.post('/movies', headers=headers,
+                              json=self.new_movie)
+            self.assertIn('read_primary_until=', res.headers['Set-Cookie'])
+            res = client.get('/movies?title_prefix=only+on+the',
+                             headers=headers)
+            self.assertEqual(json.loads(res.data)['movies'], [])
+
+            # other clients still read from the replica
+            res = self.client().get(
+                '/movies?title_prefix=only+on+the',
+                headers=self.header(self.casting_assistant))
+            self.assertEqual(len(json.loads(res.data)['movies']), 1)
+        finally:
+            router.configure([])
+            os.remove(path)
+
     # POST
     # Success behavior
     def test_create_movie(self):
@@ -83,7 +210,207 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_create_movies_bulk(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_movie,
+                  {'title': 'dexter', 'release_date': 'someday'},
+                  {'title': 'the yacoubian building',
+                   'release_date': '2006-06-21'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['created']), 2)
+        self.assertEqual([error['index'] for error in data['errors']], [1])
+
+    def test_create_actors_bulk(self):
+        res = self.client().post(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_actor, dict(self.new_actor, age='thirty')])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['created']), 1)
+        self.assertEqual(len(data['errors']), 1)
+
+        res = self.client().get('/actors/' + str(data['created'][0]),
+                                headers=self.header(self.casting_assistant))
+        self.assertEqual(res.status_code, 200)
+
+    def test_create_movie_with_idempotency_key_runs_once(self):
+        headers = self.header(self.executive_producer)
+        headers['Idempotency-Key'] = 'create-once'
+        movie = dict(self.new_movie, title='idempotent')
+
+        first = self.client().post('/movies', headers=headers, json=movie)
+        retry = self.client().post('/movies', headers=headers, json=movie)
+        res = self.client().get('/movies?title_prefix=idempotent',
+                                headers=self.header(self.casting_assistant))
+
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+
+    def test_422_reuse_idempotency_key_with_another_body(self):
+        headers = self.header(self.executive_producer)
+        headers['Idempotency-Key'] = 'reused'
+        self.client().post('/actors', headers=headers, json=self.new_actor)
+
+        res = self.client().post('/actors', headers=headers,
+                                 json=dict(self.new_actor, age=31))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_409_retry_while_first_request_is_running(self):
+        body = json.dumps(self.new_movie).encode()
+        subject = jwt.get_unverified_claims(self.executive_producer)['sub']
+        with self.app.app_context():
+            idempotency.claim(subject, 'running', hashlib.sha256(
+                b'/movies\n' + body).hexdigest())
+        headers = self.header(self.executive_producer)
+        headers['Idempotency-Key'] = 'running'
+
+        with mock.patch.dict(self.app.config, IDEMPOTENCY_WAIT=0):
+            res = self.client().post('/movies', headers=headers, data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+
+    def retry_claimed(self, key, owner, age):
+        """Retries a create whose key was claimed age seconds ago by
+        owner and never finished
+        """
+        body = json.dumps(dict(self.new_movie, title=key)).encode()
+        subject = jwt.get_unverified_claims(self.executive_producer)['sub']
+        with self.app.app_context():
+            idempotency.claim(subject, key, hashlib.sha256(
+                b'/movies\n' + body).hexdigest())
+            models.db.session.execute(
+                models.idempotency_keys.update()
+                .where(models.idempotency_keys.c.key == key)
+                .values(owner=owner, created_at=datetime.utcnow()
+                        - timedelta(seconds=age)))
+            models.db.session.commit()
+        headers = self.header(self.executive_producer)
+        headers['Idempotency-Key'] = key
+
+        with mock.patch.dict(self.app.config, IDEMPOTENCY_WAIT=0):
+            return self.client().post('/movies', headers=headers, data=body)
+
+    def test_slow_request_of_a_live_worker_is_not_run_twice(self):
+        lock_timeout = self.app.config['IDEMPOTENCY_LOCK_TIMEOUT']
+        res = self.retry_claimed('slow', idempotency.owner(),
+                                 lock_timeout * 2)
+
+        self.assertEqual(res.status_code, 409)
+
+    def test_request_of_a_dead_worker_is_taken_over(self):
+        worker = subprocess.Popen([sys.executable, '-c', ''])
+        worker.wait()
+        res = self.retry_claimed(
+            'dead-worker', f'{socket.gethostname()}:{worker.pid}', 0)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_request_of_another_host_is_taken_over_after_lock_timeout(self):
+        res = self.retry_claimed('other-host-running', 'elsewhere:1', 0)
+        self.assertEqual(res.status_code, 409)
+
+        lock_timeout = self.app.config['IDEMPOTENCY_LOCK_TIMEOUT']
+        res = self.retry_claimed('other-host-gone', 'elsewhere:1',
+                                 lock_timeout + 1)
+        self.assertEqual(res.status_code, 200)
+
+    def test_failed_request_releases_its_idempotency_key(self):
+        headers = self.header(self.executive_producer)
+        headers['Idempotency-Key'] = 'fails-first'
+
+        res = self.client().post('/movies', headers=headers,
+                                 json={'title': 'x', 'release_date': 'soon'})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post('/movies', headers=headers,
+                                 json={'title': 'x', 'release_date': 'soon'})
+        self.assertEqual(res.status_code, 400)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
     # Error behavior
+    def test_400_create_movies_bulk_without_array(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=self.new_movie)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_create_movie_with_invalid_release_date(self):
+        res = self.client().post(
+            '/movies',
+            headers=self.header(
+                self.executive_producer),
+            json={'title': 'kingdom', 'release_date': '2019/10/25'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_create_movie_without_object(self):
+        res = self.client().post(
+            '/movies',
+            headers=self.header(
+                self.executive_producer),
+            json=[1, 2])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_create_actor_with_invalid_age(self):
+        res = self.client().post(
+            '/actors',
+            headers=self.header(
+                self.executive_producer),
+            json=dict(self.new_actor, name='invalid age', age='abc'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        res = self.client().get('/actors?name_prefix=invalid+age',
+                                headers=self.header(self.casting_assistant))
+        self.assertEqual(json.loads(res.data)['actors'], [])
+
+    def test_create_without_optional_fields(self):
+        res = self.client().post(
+            '/movies',
+            headers=self.header(
+                self.executive_producer),
+            json={'title': 'no release date'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().post(
+            '/actors',
+            headers=self.header(
+                self.executive_producer),
+            json={'name': 'no gender', 'age': 40, 'gender': None})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/actors?name_prefix=no+gender',
+                                headers=self.header(self.casting_assistant))
+        actors = json.loads(res.data)['actors']
+        self.assertEqual([actor['gender'] for actor in actors], [None])
+
     def test_401_post_movie_without_auth_header(self):
         res = self.client().post('/movies', json=self.new_movie)
         data = json.loads(res.data)
@@ -120,7 +447,451 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_get_movies_paginated(self):
+        self.client().post(
+            '/movies',
+            headers=self.header(
+                self.executive_producer),
+            json=self.new_movie)
+        res = self.client().get('/movies?limit=1',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertTrue(data['next'])
+
+        res = self.client().get('/movies?limit=1&after=' + data['next'],
+                                headers=self.header(self.casting_assistant))
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page['movies'][0]['id'],
+                           data['movies'][0]['id'])
+
+    def test_get_actors_by_page(self):
+        res = self.client().get('/actors?limit=1&page=1',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['page'], 1)
+
+    def test_get_movies_streamed(self):
+        res = self.client().get('/movies?stream=1',
+                                headers=self.header(self.casting_assistant))
+        movies = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(movies)
+        self.assertIn('title', movies[0])
+
+    def test_get_actors_streamed_by_accept_header(self):
+        headers = self.header(self.casting_assistant)
+        headers['Accept'] = 'application/x-ndjson'
+        res = self.client().get('/actors', headers=headers)
+        actors = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(actors)
+        self.assertIn('name', actors[0])
+
+    def test_get_movies_with_fields(self):
+        res = self.client().get('/movies?fields=title',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'id', 'title'})
+
+    def test_get_actor(self):
+        res = self.client().get('/actors/1?fields=name,age',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['id'], 1)
+        self.assertEqual(set(data['actor']), {'id', 'name', 'age'})
+
+    def test_304_get_movies_with_matching_etag(self):
+        res = self.client().get('/movies',
+                                headers=self.header(self.casting_assistant))
+        etag = res.headers['ETag']
+
+        headers = self.header(self.casting_assistant)
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_etag_of_movies_changes_after_a_write(self):
+        res = self.client().get('/movies',
+                                headers=self.header(self.casting_assistant))
+        etag = res.headers['ETag']
+        self.client().post('/movies',
+                           headers=self.header(self.executive_producer),
+                           json=self.new_movie)
+
+        headers = self.header(self.casting_assistant)
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_cached_movies_are_invalidated_by_another_worker(self):
+        path = '/movies?title_prefix=other+worker'
+        headers = self.header(self.casting_assistant)
+        self.client().get(path, headers=headers)
+        res = self.client().get(path, headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        # another worker shares nothing with this one but the database,
+        # its write never touches this worker's response cache
+        with self.app.app_context():
+            models.db.session.execute(Movies.__table__.insert().values(
+                title='other worker', updated_at=datetime.utcnow()))
+            models.commit('movies')
+
+        res = self.client().get(path, headers=headers)
+        self.assertNotIn('X-Cache', res.headers)
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+
+    def test_304_get_actor_if_not_modified_since(self):
+        res = self.client().post('/actors/bulk',
+                                 headers=self.header(self.executive_producer),
+                                 json=[self.new_actor])
+        path = '/actors/' + str(json.loads(res.data)['created'][0])
+        res = self.client().get(path,
+                                headers=self.header(self.casting_assistant))
+        self.assertIn('Last-Modified', res.headers)
+
+        headers = self.header(self.casting_assistant)
+        headers['If-Modified-Since'] = res.headers['Last-Modified']
+        res = self.client().get(path, headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_etag_of_actor_changes_after_an_update(self):
+        res = self.client().post('/actors/bulk',
+                                 headers=self.header(self.executive_producer),
+                                 json=[self.new_actor])
+        path = '/actors/' + str(json.loads(res.data)['created'][0])
+        res = self.client().get(path,
+                                headers=self.header(self.casting_assistant))
+        etag = res.headers['ETag']
+        self.client().patch(path,
+                            headers=self.header(self.executive_producer),
+                            json={'age': 31})
+
+        headers = self.header(self.casting_assistant)
+        headers['If-None-Match'] = etag
+        res = self.client().get(path, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_search_movies_and_actors(self):
+        self.client().post('/movies/bulk',
+                           headers=self.header(self.executive_producer),
+                           json=[dict(self.new_movie,
+                                      title='the searchable kingdom'),
+                                 dict(self.new_movie, title='searchable')])
+        self.client().post('/actors/bulk',
+                           headers=self.header(self.executive_producer),
+                           json=[dict(self.new_actor,
+                                      name='searchable kingsley')])
+
+        res = self.client().get('/search?q=searchab+king',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            sorted((result['type'], result.get('title', result.get('name')))
+                   for result in data['results']),
+            [('actor', 'searchable kingsley'),
+             ('movie', 'the searchable kingdom')])
+
+        res = self.client().get('/search?q=searchable&type=movie&limit=1',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['type'], 'movie')
+        self.assertEqual(data['next_page'], 2)
+
+    def test_get_actor_stats(self):
+        self.client().post('/actors/bulk',
+                           headers=self.header(self.executive_producer),
+                           json=[dict(self.new_actor, name='stats', age=age)
+                                 for age in (61, 64, 75)])
+
+        res = self.client().get('/stats/actors?name_prefix=stats'
+                                '&age_bucket=5',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['by_gender'],
+                         [{'gender': 'female', 'count': 3}])
+        self.assertEqual(data['by_age'], [{'from': 60, 'count': 2},
+                                          {'from': 75, 'count': 1}])
+
+    def test_get_movie_stats(self):
+        self.client().post('/movies/bulk',
+                           headers=self.header(self.executive_producer),
+                           json=[dict(self.new_movie, release_date=day)
+                                 for day in ('1921-01-05', '1929-06-01',
+                                             '1935-03-02')])
+
+        res = self.client().get('/stats/movies?released_before=1940-01-01'
+                                '&year_bucket=10',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['by_year'], [{'from': 1920, 'count': 2},
+                                           {'from': 1930, 'count': 1}])
+
+    def test_400_get_actor_stats_with_invalid_bucket(self):
+        res = self.client().get('/stats/actors?age_bucket=0',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_stats_with_out_of_range_bucket(self):
+        for url in ('/stats/actors?age_bucket=99999999999999999999',
+                    '/stats/movies?year_bucket=99999999999999999999'):
+            res = self.client().get(url, headers=self.header(
+                self.casting_assistant))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, url)
+            self.assertEqual(data['success'], False)
+
+    def test_400_search_without_words(self):
+        res = self.client().get('/search?q=%25%25',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_search_with_out_of_range_page(self):
+        res = self.client().get('/search?q=king&page=2147483647',
+                                headers=self.header(self.casting_assistant))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['results'], [])
+
+        res = self.client().get('/search?q=king&page=99999999999999999999',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_filtered_and_sorted(self):
+        for age in (21, 45, 33):
+            self.client().post(
+                '/actors',
+                headers=self.header(
+                    self.executive_producer),
+                json=dict(self.new_actor, age=age, gender='male'))
+
+        ids = []
+        ages = []
+        after = ''
+        while after is not None:
+            res = self.client().get(
+                '/actors?gender=male&age_min=21&sort=-age&limit=2' + after,
+                headers=self.header(self.casting_assistant))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+
+            ids += [actor['id'] for actor in data['actors']]
+            ages += [actor['age'] for actor in data['actors']]
+            after = '&after=' + data['next'] if data['next'] else None
+
+        self.assertEqual(ages, sorted(ages, reverse=True))
+        self.assertTrue(all(age >= 21 for age in ages))
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_400_get_actors_with_out_of_range_age(self):
+        for query in ('age_min=99999999999999999999',
+                      'age_max=-99999999999999999999', 'age_min=abc'):
+            res = self.client().get('/actors?' + query,
+                                    headers=self.header(
+                                        self.casting_assistant))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(data['success'], False)
+
+    def test_get_latest_releases(self):
+        for release_date in ('1-9-2019', '2021-03-04', '15-06-2020'):
+            self.client().post(
+                '/movies',
+                headers=self.header(
+                    self.executive_producer),
+                json=dict(self.new_movie, release_date=release_date))
+
+        res = self.client().get(
+            '/movies?released_after=2019-12-31&sort=-release_date',
+            headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+        release_dates = [movie['release_date'] for movie in data['movies']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('2021-03-04', release_dates)
+        self.assertNotIn('2019-09-01', release_dates)
+        self.assertEqual(release_dates, sorted(release_dates, reverse=True))
+
+    def test_get_movies_by_title_prefix(self):
+        res = self.client().get('/movies?title_prefix=king',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(movie['title'].startswith('king')
+                            for movie in data['movies']))
+
+    def test_assign_cast_and_get_movies_with_actors(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_movie] * 3)
+        movie_ids = json.loads(res.data)['created']
+        res = self.client().post(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_actor] * 3)
+        actor_ids = json.loads(res.data)['created']
+
+        for movie_id in movie_ids:
+            res = self.client().post(
+                '/movies/' + str(movie_id) + '/actors',
+                headers=self.header(
+                    self.executive_producer),
+                json={'actor_ids': actor_ids + [100000]})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['assigned'], actor_ids)
+            self.assertEqual(data['skipped'], [100000])
+
+        # the table versions, the page and the cast of all its movies:
+        # three queries, not 1 + N
+        with self.count_queries() as statements:
+            res = self.client().get(
+                '/movies?include=actors&limit=100',
+                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+        movies = {movie['id']: movie for movie in data['movies']}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual([actor['id'] for actor in movies[movie_ids[0]]
+                          ['actors']], actor_ids)
+
+        res = self.client().get(
+            '/actors/' + str(actor_ids[0]) + '?include=movies',
+            headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual([movie['id'] for movie in data['actor']['movies']],
+                         movie_ids)
+
+    def test_unassign_cast(self):
+        res = self.client().post(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_actor])
+        actor_ids = json.loads(res.data)['created']
+        self.client().post(
+            '/movies/1/actors',
+            headers=self.header(
+                self.executive_producer),
+            json={'actor_ids': actor_ids})
+
+        res = self.client().delete(
+            '/movies/1/actors',
+            headers=self.header(
+                self.executive_producer),
+            json={'actor_ids': actor_ids})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['unassigned'], actor_ids)
+
     # Error behavior
+    def test_404_assign_cast_to_missing_movie(self):
+        res = self.client().post(
+            '/movies/100000/actors',
+            headers=self.header(
+                self.executive_producer),
+            json={'actor_ids': [1]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_sorted_by_unindexed_column(self):
+        res = self.client().get('/actors?sort=gender',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_movies_with_unknown_field(self):
+        res = self.client().get('/movies?fields=budget',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_404_get_missing_movie(self):
+        res = self.client().get('/movies/100000',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_movies_with_invalid_cursor(self):
+        res = self.client().get('/movies?after=not-a-cursor',
+                                headers=self.header(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_movies_with_out_of_range_integers(self):
+        huge = 99999999999999999999
+        for query in (f'page={huge}', f'limit={huge}',
+                      'after=' + encode_cursor([huge]),
+                      'sort=-title&after=' + encode_cursor(['a', huge])):
+            res = self.client().get('/movies?' + query,
+                                    headers=self.header(
+                                        self.casting_assistant))
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(data['success'], False)
+
     def test_401_get_movies_without_auth_header(self):
         res = self.client().get('/movies')
         data = json.loads(res.data)
@@ -134,6 +905,47 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
         self.assertEqual(data['success'], False)
+
+    def test_401_get_movies_with_expired_token(self):
+        with self.app.app_context():
+            token = auth.mint_token('casting_assistant', expires_in=-60)
+        res = self.client().get('/movies', headers=self.header(token))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+
+    def test_401_get_movies_with_malformed_token(self):
+        res = self.client().get('/movies', headers=self.header('abc'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message']['code'], 'invalid_header')
+
+    def test_400_get_movies_with_forged_alg(self):
+        settings = self.app.extensions['auth']
+        # signed with RS256, but its header names an algorithm that is
+        # only a part of ALGORITHMS
+        for alg in ('S2', 'RS', '256'):
+            token = jwt.encode(
+                {'iss': settings.issuer, 'aud': settings.audience,
+                 'sub': 'local|forger', 'permissions': ['get:movies']},
+                KEYS.pem, algorithm='RS256',
+                headers={'kid': KEYS.kid, 'alg': alg})
+            self.assertEqual(jwt.get_unverified_header(token)['alg'], alg)
+            res = self.client().get('/movies', headers=self.header(token))
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_400_get_movies_with_token_of_another_key(self):
+        settings = self.app.extensions['auth']
+        token = LocalKeyPair(bits=1024).mint(
+            settings.issuer, settings.audience, ['get:movies'])
+        res = self.client().get('/movies', headers=self.header(token))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
     # ----------------------------------------------------------------------------------------------------------
     # # PATCH
     # Success behavior
@@ -162,7 +974,126 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_update_movies_bulk(self):
+        res = self.client().post(
+            '/movies/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_movie, self.new_movie])
+        ids = json.loads(res.data)['created']
+
+        res = self.client().patch(
+            '/movies/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[{'id': ids[0], 'changes': {'title': 'first'}},
+                  {'id': ids[1], 'changes': {'title': 'second'}},
+                  {'id': 100000, 'changes': {'title': 'missing'}},
+                  {'id': ids[0], 'changes': {'budget': 10}}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(data['not_found'], [100000])
+        self.assertEqual([error['index'] for error in data['errors']], [3])
+
+        res = self.client().get('/movies/' + str(ids[1]),
+                                headers=self.header(self.casting_assistant))
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'second')
+
+    def test_update_actors_bulk_with_same_changes(self):
+        res = self.client().patch(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json={'ids': [1, 100000], 'changes': {'age': 31}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], [1])
+        self.assertEqual(data['not_found'], [100000])
+
     # Error behavior
+    def test_400_update_actors_bulk_with_invalid_changes(self):
+        res = self.client().patch(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json={'ids': [1], 'changes': {'age': 'old'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_bulk_with_out_of_range_ids(self):
+        huge = 99999999999999999999
+        headers = self.header(self.executive_producer)
+        for res in (
+                self.client().patch('/movies/bulk', headers=headers,
+                                    json={'ids': [1, huge],
+                                          'changes': {'title': 'huge'}}),
+                self.client().delete('/actors/bulk', headers=headers,
+                                     json={'ids': [huge]}),
+                self.client().post('/actors', headers=headers,
+                                   json=dict(self.new_actor, age=huge))):
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+        res = self.client().patch('/movies/bulk', headers=headers,
+                                  json=[{'id': huge,
+                                         'changes': {'title': 'huge'}}])
+        data = json.loads(res.data)
+        self.assertEqual(data['errors'],
+                         [{'index': 0, 'message': 'id is required'}])
+
+        for res in (self.client().get(f'/movies/{huge}', headers=headers),
+                    self.client().delete(f'/actors/{huge}',
+                                         headers=headers)):
+            self.assertEqual(res.status_code, 404)
+
+    def test_404_update_missing_movie(self):
+        res = self.client().patch(
+            '/movies/100000',
+            headers=self.header(
+                self.executive_producer),
+            json={'title': 'new-title'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_writes_matching_no_row_keep_the_versions(self):
+        headers = self.header(self.executive_producer)
+        res = self.client().post('/movies/bulk', headers=headers,
+                                 json=[self.new_movie])
+        movie_id = json.loads(res.data)['created'][0]
+        with self.app.app_context():
+            before = models.versions(models.VERSIONED_TABLES)
+
+        for res in (
+                self.client().patch('/movies/100000', headers=headers,
+                                    json={'title': 'new-title'}),
+                self.client().delete('/actors/100000', headers=headers),
+                self.client().patch('/movies/bulk', headers=headers,
+                                    json={'ids': [100000],
+                                          'changes': {'title': 'x'}}),
+                self.client().delete('/actors/bulk', headers=headers,
+                                     json={'ids': [100000]}),
+                self.client().post(f'/movies/{movie_id}/actors',
+                                   headers=headers,
+                                   json={'actor_ids': [100000]}),
+                self.client().delete(f'/movies/{movie_id}/actors',
+                                     headers=headers,
+                                     json={'actor_ids': [100000]})):
+            self.assertIn(res.status_code, (200, 404))
+            self.assertNotIn('Set-Cookie', res.headers)
+
+        with self.app.app_context():
+            self.assertEqual(models.versions(models.VERSIONED_TABLES),
+                             before)
+
     def test_401_update_movie_partially_without_auth_header(self):
         res = self.client().patch('/movies/1', json={'title': 'new-title'})
         data = json.loads(res.data)
@@ -201,7 +1132,63 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_delete_actors_bulk(self):
+        res = self.client().post(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json=[self.new_actor, self.new_actor])
+        ids = json.loads(res.data)['created']
+
+        res = self.client().delete(
+            '/actors/bulk',
+            headers=self.header(
+                self.executive_producer),
+            json={'ids': ids + [100000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(data['not_found'], [100000])
+
+    def test_bulk_endpoints_stay_within_their_query_budgets(self):
+        # several chunks per request, a statement too many is a 500
+        self.assertEqual(self.app.config['QUERY_BUDGETS'], 'raise')
+        patch = mock.patch.dict(self.app.config, BULK_CHUNK_SIZE=2)
+        patch.start()
+        self.addCleanup(patch.stop)
+        headers = self.header(self.executive_producer)
+
+        res = self.client().post('/movies/bulk', headers=headers,
+                                 json=[self.new_movie] * 5)
+        ids = json.loads(res.data)['created']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(ids), 5)
+
+        for body in ({'ids': ids, 'changes': {'title': 'same'}},
+                     [{'id': movie_id, 'changes': {'title': str(movie_id)}}
+                      for movie_id in ids]):
+            res = self.client().patch('/movies/bulk', headers=headers,
+                                      json=body)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['updated'], ids)
+
+        res = self.client().delete('/movies/bulk', headers=headers,
+                                   json={'ids': ids})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['deleted'], ids)
+
     # Error behavior
+    def test_404_delete_missing_actor(self):
+        res = self.client().delete(
+            '/actors/100000',
+            headers=self.header(
+                self.executive_producer))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_401_delete_movie_without_auth_header(self):
         res = self.client().delete('/movies/2')
         data = json.loads(res.data)
@@ -258,6 +1245,145 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_403_create_movie_with_casting_assistant(self):
+        res = self.client().post(
+            '/movies',
+            headers=self.header(
+                self.casting_assistant),
+            json=self.new_movie)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+
+class CreateAppTestCase(unittest.TestCase):
+    """This class represents the application factory test case"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'app.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def test_config_is_applied(self):
+        class Config:
+            DATABASE_URL = self.url
+            TESTING = True
+
+        app = create_app(Config)
+
+        self.assertTrue(app.testing)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], self.url)
+        self.assertIn('/movies',
+                      [rule.rule for rule in app.url_map.iter_rules()])
+        res = app.test_client().get('/health')
+        self.assertEqual(res.status_code, 200)
+
+    def test_apps_keep_their_own_engines(self):
+        other = 'sqlite:///' + os.path.join(self.directory, 'other.sqlite')
+        first = create_app({'DATABASE_URL': self.url})
+        second = create_app({'DATABASE_URL': other,
+                             'DATABASE_REPLICA_URLS': ['sqlite://']})
+
+        for app, url, replicas in ((first, self.url, 0), (second, other, 1),
+                                   (APP, os.environ['DATABASE_URL'], 0)):
+            with app.app_context():
+                self.assertEqual(str(models.db.engine.url), url)
+                self.assertEqual(models.db.router.stats()['replicas'],
+                                 replicas)
+        self.assertIsNot(models.db.get_router(first),
+                         models.db.get_router(second))
+
+    def test_apps_verify_tokens_for_their_own_audience(self):
+        keys = LocalKeyPair(bits=1024)
+        first = create_app({'DATABASE_URL': self.url,
+                            'API_AUDIENCE': 'first'})
+        second = create_app({'DATABASE_URL': self.url,
+                             'API_AUDIENCE': 'second'})
+        for app in (first, second):
+            auth.use_key_provider(keys, app)
+        with first.app_context():
+            models.db.create_all()
+            token = auth.mint_token('casting_assistant')
+        headers = {'Authorization': 'bearer ' + token}
+
+        res = first.test_client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = second.test_client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(json.loads(res.data)['message']['code'],
+                         'invalid_claims')
+
+    def test_401_while_the_jwks_cannot_be_fetched(self):
+        app = create_app({
+            'DATABASE_URL': self.url, 'AUTH_KEYS': 'jwks',
+            'AUTH0_DOMAIN': 'tenant.auth0.com', 'API_AUDIENCE': 'api',
+            'JWKS_URL': Path(self.directory, 'missing.json').as_uri()})
+
+        for _ in range(2):
+            res = app.test_client().get(
+                '/movies', headers={'Authorization': 'bearer ' +
+                                    EXECUTIVE_PRODUCER})
+            self.assertEqual(res.status_code, 401)
+            self.assertEqual(json.loads(res.data)['message']['code'],
+                             'jwks_unavailable')
+
+    def test_auth0_settings_are_required(self):
+        with self.assertRaises(ValueError):
+            create_app({'DATABASE_URL': self.url, 'AUTH_KEYS': 'jwks',
+                        'AUTH0_DOMAIN': '', 'API_AUDIENCE': ''})
+
+    def test_apps_keep_their_own_settings(self):
+        first = create_app({'DATABASE_URL': self.url,
+                            'RESPONSE_CACHE': 'off', 'MAX_PAGE_SIZE': 1})
+        second = create_app({'DATABASE_URL': self.url,
+                             'JSON_SERIALIZER': 'json'})
+
+        self.assertFalse(first.extensions['response_cache'].enabled)
+        self.assertTrue(second.extensions['response_cache'].enabled)
+        self.assertIsNot(second.extensions['response_cache'],
+                         APP.extensions['response_cache'])
+        self.assertEqual(second.extensions['serializer'].backend, 'json')
+        self.assertEqual(first.config['MAX_PAGE_SIZE'], 1)
+        self.assertEqual(second.config['MAX_PAGE_SIZE'], 500)
+        self.assertEqual(first.config['QUERY_BUDGETS'], 'raise')
+
+    def test_invalid_settings_fail_in_create_app(self):
+        for config in ({'QUERY_BUDGETS': 'sometimes'},
+                       {'JSON_SERIALIZER': 'yaml'},
+                       {'RESPONSE_CACHE': 'disk'},
+                       {'DEFAULT_PAGE_SIZE': 'many'}):
+            with self.assertRaises(ValueError):
+                create_app(dict(config, DATABASE_URL=self.url))
+
+    def test_engines_reconnect_after_dispose(self):
+        app = create_app({'DATABASE_URL': self.url})
+        with app.app_context():
+            models.db.session.execute('SELECT 1')
+            models.db.session.remove()
+            models.dispose_engines(app)
+
+            self.assertEqual(
+                models.db.session.execute('SELECT 1').scalar(), 1)
+            models.db.session.remove()
+
+    def test_import_does_no_setup(self):
+        # no DATABASE_URL and no Auth0 settings, and invalid ones that
+        # only create_app() reads
+        script = ('import sys, app; '
+                  'assert "APP" not in vars(app); '
+                  'assert "flask_migrate" not in sys.modules')
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            env={'PATH': os.defpath, 'QUERY_BUDGETS': 'sometimes',
+                 'JSON_SERIALIZER': 'yaml', 'RESPONSE_CACHE': 'disk'},
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE)
+
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
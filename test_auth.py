@@ -0,0 +1,224 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from jose import jwk, jwt
+from jose.utils import base64url_decode
+
+from auth.auth import key_provider_from_env, check_settings
+from auth.cache import TokenCache
+from auth.jwks import JWKSKeyStore, JWKSUnavailable, max_age
+from auth.keys import LocalKeyPair
+
+
+KEYS = LocalKeyPair(bits=1024)
+
+
+def jwks_document(*kids):
+    return {'keys': [{
+        **KEYS.jwks()['keys'][0],
+        'kid': kid
+    } for kid in kids]}
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write_jwks('key-1')
+        self.store = JWKSKeyStore(Path(self.path).as_uri(),
+                                  min_refresh_interval=0)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_jwks(self, *kids):
+        with open(self.path, 'w') as f:
+            json.dump(jwks_document(*kids), f)
+
+    def test_get_key(self):
+        key = self.store.get_key('key-1')
+
+        self.assertIsInstance(key, jwk.Key)
+        signing_input, _, signature = KEYS.mint('iss', 'aud', []) \
+            .rpartition('.')
+        self.assertTrue(key.verify(signing_input.encode(),
+                                   base64url_decode(signature.encode())))
+        # constructed once, not for every token
+        self.assertIs(self.store.get_key('key-1'), key)
+
+    def test_unknown_kid_triggers_refresh(self):
+        self.store.get_key('key-1')
+        self.write_jwks('key-1', 'key-2')
+
+        self.assertIsNotNone(self.store.get_key('key-2'))
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        self.store.min_refresh_interval = 3600
+        self.store.get_key('key-1')
+        self.write_jwks('key-2')
+
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertIsNotNone(self.store.get_key('key-1'))
+
+    def test_keeps_stale_keys_when_fetch_fails(self):
+        self.store.get_key('key-1')
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.store.refresh()
+
+        self.assertIsNotNone(self.store.get_key('key-1'))
+
+    def test_fetch_without_keys_is_rate_limited(self):
+        # a cold start while the JWKS can't be fetched
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.store.min_refresh_interval = 3600
+        fetches = []
+        fetch = self.store._fetch
+        self.store._fetch = lambda: fetches.append(1) or fetch()
+
+        for _ in range(5):
+            with self.assertRaises(JWKSUnavailable):
+                self.store.get_key('key-1')
+        self.assertEqual(len(fetches), 1)
+
+        self.write_jwks('key-1')
+        self.store.min_refresh_interval = 0
+        self.assertIsNotNone(self.store.get_key('key-1'))
+
+    def test_invalid_key_is_skipped(self):
+        document = jwks_document('key-1', 'key-2')
+        document['keys'][1]['n'] = 0
+        with open(self.path, 'w') as f:
+            json.dump(document, f)
+
+        self.assertIsNotNone(self.store.get_key('key-1'))
+        self.assertIsNone(self.store.get_key('key-2'))
+
+    def test_max_age(self):
+        self.assertEqual(max_age('public, max-age=120', 600), 120)
+        self.assertEqual(max_age('', 600), 600)
+        self.assertEqual(max_age('no-store', 600), 0)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.cache = TokenCache(max_entries=2)
+        self.payload = {'sub': 'user', 'exp': time.time() + 60}
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.set('token', self.payload)
+
+        self.assertIs(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_entry_expires_at_exp_claim(self):
+        self.cache.set('token', {'sub': 'user', 'exp': time.time() - 1})
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('token-1', self.payload)
+        self.cache.set('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.set('token-3', self.payload)
+
+        self.assertIsNotNone(self.cache.get('token-1'))
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertIsNotNone(self.cache.get('token-3'))
+
+
+class LocalKeyPairTestCase(unittest.TestCase):
+    """This class represents the local key pair test case"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'key.pem')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(self.directory)
+
+    def test_minted_token_verifies_with_its_key(self):
+        keys = LocalKeyPair(bits=1024)
+        token = keys.mint('https://test.local/', 'aud', ['get:movies'],
+                          subject='user')
+        kid = jwt.get_unverified_header(token)['kid']
+
+        signing_input, _, signature = token.rpartition('.')
+        self.assertTrue(keys.get_key(kid).verify(
+            signing_input.encode(), base64url_decode(signature.encode())))
+        payload = jwt.get_unverified_claims(token)
+        self.assertEqual(payload['permissions'], ['get:movies'])
+        self.assertEqual(payload['sub'], 'user')
+        self.assertIsNone(keys.get_key('another'))
+
+    def test_load_creates_the_key_once(self):
+        keys = LocalKeyPair.load(self.path, bits=1024)
+        token = keys.mint('https://test.local/', 'aud', [])
+
+        again = LocalKeyPair.load(self.path)
+        self.assertEqual(again.jwks(), keys.jwks())
+        jwt.decode(token, again.jwks(), algorithms='RS256', audience='aud')
+
+    def test_load_race_keeps_the_first_key(self):
+        # another worker writes the file after this one checked for it
+        winner = LocalKeyPair.load(self.path, bits=1024)
+        with mock.patch('os.path.exists', return_value=False):
+            loser = LocalKeyPair.load(self.path, bits=1024)
+
+        self.assertEqual(loser.jwks(), winner.jwks())
+        self.assertEqual(os.listdir(self.directory), ['key.pem'])
+
+    def test_concurrent_loads_share_one_key(self):
+        with ThreadPoolExecutor(4) as pool:
+            key_pairs = list(pool.map(
+                lambda _: LocalKeyPair.load(self.path, bits=512), range(4)))
+
+        self.assertEqual(len({json.dumps(keys.jwks())
+                              for keys in key_pairs}), 1)
+        self.assertEqual(os.listdir(self.directory), ['key.pem'])
+
+    def test_key_provider_from_env(self):
+        keys = LocalKeyPair(bits=1024)
+        with open(self.path, 'w') as f:
+            f.write(keys.pem)
+        provider = key_provider_from_env({'AUTH_KEYS': 'local:' + self.path})
+        self.assertEqual(provider.jwks(), keys.jwks())
+
+        store = key_provider_from_env({'JWKS_URL': 'file:///jwks.json'})
+        self.assertIsInstance(store, JWKSKeyStore)
+        self.assertEqual(store.url, 'file:///jwks.json')
+
+        with self.assertRaises(ValueError):
+            key_provider_from_env({'AUTH_KEYS': 'auth0'})
+
+    def test_auth0_settings_are_required(self):
+        auth0 = {'AUTH0_DOMAIN': 'tenant.auth0.com', 'API_AUDIENCE': 'api'}
+        check_settings(auth0)
+        check_settings({'AUTH_KEYS': 'local'})
+        check_settings({'AUTH_KEYS': 'local:' + self.path})
+
+        for environ in ({}, {'AUTH0_DOMAIN': 'tenant.auth0.com'},
+                        dict(auth0, AUTH_KEYS='jwks', API_AUDIENCE='')):
+            with self.assertRaises(ValueError):
+                check_settings(environ)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from database.cache import ResponseCache, MemoryBackend, RedisBackend
+
+
+class RedisStandIn:
+    """The part of the redis client the cache uses, kept in a dict"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def backends(self):
+        return [MemoryBackend(max_entries=8), RedisBackend(RedisStandIn())]
+
+    def test_get_what_was_set(self):
+        for backend in self.backends():
+            cache = ResponseCache(backend)
+            key = cache.key('/movies', [('limit', '1')], ['get:movies'],
+                            [('movies', 1, None)])
+            cache.set(key, b'{"success":true}', 200, 'application/json')
+
+            self.assertEqual(cache.get(key), (b'{"success":true}', 200,
+                                              'application/json'))
+
+    def test_key_changes_with_the_versions(self):
+        cache = ResponseCache(MemoryBackend())
+
+        self.assertNotEqual(
+            cache.key('/movies', [], ['get:movies'], [('movies', 1, None)]),
+            cache.key('/movies', [], ['get:movies'], [('movies', 2, None)]))
+
+    def test_key_depends_on_permission_scope(self):
+        cache = ResponseCache(MemoryBackend())
+
+        self.assertNotEqual(
+            cache.key('/movies', [], ['get:movies'], [('movies', 1, None)]),
+            cache.key('/movies', [], ['get:movies', 'post:movies'],
+                      [('movies', 1, None)]))
+
+    def test_lru_eviction(self):
+        backend = MemoryBackend(max_entries=1)
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), b'2')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
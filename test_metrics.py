@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import metrics
+from metrics import Counter, Histogram, RequestTimer, escape
+
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the Prometheus metrics test case"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ('route',),
+                              (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, '/movies')
+
+        self.assertEqual(histogram.render(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/movies",le="0.1"} 2',
+            'latency_seconds_bucket{route="/movies",le="1.0"} 3',
+            'latency_seconds_bucket{route="/movies",le="+Inf"} 4',
+            'latency_seconds_sum{route="/movies"} 2.65',
+            'latency_seconds_count{route="/movies"} 4'
+        ])
+
+    def test_histogram_keeps_a_series_per_label(self):
+        histogram = Histogram('statements', 'Statements.', ('route',), (1,))
+        histogram.observe(1, '/movies')
+        histogram.observe(3, '/actors')
+
+        lines = histogram.render()
+
+        self.assertIn('statements_count{route="/actors"} 1', lines)
+        self.assertIn('statements_count{route="/movies"} 1', lines)
+        self.assertIn('statements_bucket{route="/actors",le="1"} 0', lines)
+
+    def test_counter(self):
+        counter = Counter('requests_total', 'Requests.', ('status',))
+        counter.inc('200')
+        counter.inc('200')
+        counter.inc('404')
+
+        self.assertEqual(counter.render()[2:], [
+            'requests_total{status="200"} 2',
+            'requests_total{status="404"} 1'
+        ])
+
+    def test_escape(self):
+        self.assertEqual(escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+    def test_timer_adds_up_phases(self):
+        timer = RequestTimer()
+        timer.add('db', 0.25)
+        timer.add('db', 0.5)
+
+        self.assertEqual(timer.phases, {'db': 0.75})
+
+    def test_render_adds_up_the_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        counter = Counter('requests_total', 'Requests.', ('status',))
+        histogram = Histogram('statements', 'Statements.', ('route',), (1,))
+        counter.inc('200')
+        histogram.observe(1, '/movies')
+        # another worker, and one that has exited
+        for name, count in (('metrics-1-a.json', 2), ('metrics-2-b.json', 1)):
+            with open(os.path.join(directory.name, name), 'w') as f:
+                json.dump({'requests_total': [[['200'], count]],
+                           'statements': [[['/movies'], [count, 0], count]]},
+                          f)
+
+        with mock.patch.object(metrics, 'METRICS', (counter, histogram)), \
+                mock.patch.object(metrics, '_flushed', [None, None, None]):
+            lines = metrics.render(directory.name).splitlines()
+            again = metrics.render(directory.name).splitlines()
+
+        self.assertIn('requests_total{status="200"} 4', lines)
+        self.assertIn('statements_bucket{route="/movies",le="1"} 4', lines)
+        self.assertIn('statements_sum{route="/movies"} 4', lines)
+        self.assertEqual(again, lines)
+        self.assertEqual(len(os.listdir(directory.name)), 3)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import sqlite3
+import unittest
+from unittest import mock
+from flask import Flask
+from sqlalchemy import exc
+
+from database.models import pool_config, engine_options, TimedQueuePool
+from database.replicas import ReplicaRouter
+
+
+class PoolConfigTestCase(unittest.TestCase):
+    """This class represents the connection pool settings test case"""
+
+    def test_defaults(self):
+        settings = pool_config({})
+
+        self.assertEqual(settings['pool_size'], 5)
+        self.assertEqual(settings['statement_timeout'], 30000)
+
+    def test_config_overrides_environment(self):
+        settings = pool_config({'DB_POOL_SIZE': '8', 'DB_MAX_OVERFLOW': '2'},
+                               {'pool_size': 3})
+
+        self.assertEqual(settings['pool_size'], 3)
+        self.assertEqual(settings['max_overflow'], 2)
+
+    def test_invalid_settings(self):
+        for environ, config in (({'DB_POOL_SIZE': 'many'}, None),
+                                ({'DB_POOL_SIZE': '0'}, None),
+                                ({}, {'pool_sise': 3})):
+            with self.assertRaises(ValueError):
+                pool_config(environ, config)
+
+    def test_engine_options(self):
+        settings = pool_config({'DB_STATEMENT_TIMEOUT': '500'})
+        options = engine_options('postgresql://db/casting', settings)
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=500'})
+        self.assertEqual(engine_options('sqlite:///casting.db', settings), {})
+
+    def test_timed_pool_counts_timeouts(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                              pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        connection.close()
+
+        self.assertEqual(pool.checkouts, 2)
+        self.assertEqual(pool.timeouts, 1)
+        self.assertGreaterEqual(pool.wait_time, 0.05)
+
+
+class ReplicaRouterTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def router(self, policy, secret=None):
+        router = ReplicaRouter(policy, secret=secret)
+        router.configure(['sqlite://', 'sqlite://'])
+        self.addCleanup(router.configure, [])
+        return router
+
+    def read_engine(self, router, method='GET', cookie=None):
+        headers = {'Cookie': cookie} if cookie else {}
+        with self.app.test_request_context(method=method, headers=headers):
+            return router.read_engine()
+
+    def write(self, router):
+        """Returns the Set-Cookie header of a write routed by router"""
+        with self.app.test_request_context(method='POST'):
+            self.assertIsNone(router.read_engine())
+            router.wrote()
+            response = router.set_sticky_cookie(self.app.response_class())
+        return response.headers.get('Set-Cookie', '').split(';')[0]
+
+    def test_round_robin(self):
+        router = self.router('round_robin')
+
+        self.assertEqual([self.read_engine(router) for _ in range(3)],
+                         [router.engines[0], router.engines[1],
+                          router.engines[0]])
+
+    def test_least_connections(self):
+        router = self.router('least_connections')
+        connection = router.engines[0].connect()
+        self.addCleanup(connection.close)
+
+        self.assertIs(self.read_engine(router), router.engines[1])
+
+    def test_writes_and_sticky_clients_use_the_primary(self):
+        router = self.router('round_robin')
+        cookie = self.write(router)
+
+        self.assertTrue(cookie.startswith('read_primary_until='))
+        self.assertIsNone(self.read_engine(router, cookie=cookie))
+        self.assertIsNotNone(self.read_engine(router))
+
+    def test_sticky_cookie_is_honoured_by_another_worker(self):
+        # two workers: their routers share the secret and nothing else
+        worker_a = self.router('round_robin', secret=b'secret')
+        worker_b = self.router('round_robin', secret=b'secret')
+        cookie = self.write(worker_a)
+
+        self.assertIsNone(self.read_engine(worker_b, cookie=cookie))
+        self.assertIsNotNone(self.read_engine(worker_b))
+
+    def test_sticky_cookie_is_checked(self):
+        router = self.router('round_robin', secret=b'secret')
+        cookie = self.write(router)
+        until = int(cookie.split('=')[1].split('.')[0])
+
+        forged = f'read_primary_until={until}.0123'
+        self.assertIsNotNone(self.read_engine(router, cookie=forged))
+        other = self.write(self.router('round_robin', secret=b'other'))
+        self.assertIsNotNone(self.read_engine(router, cookie=other))
+        with mock.patch('time.time', return_value=until + 1):
+            self.assertIsNotNone(self.read_engine(router, cookie=cookie))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine
+
+from database import profiler
+from database.profiler import QueryBudgetExceeded, query_budget, shape, \
+    setup_profiler
+from metrics import start_timer
+from settings import load_settings
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """This class represents the SQL profiler test case"""
+
+    def setUp(self):
+        profiler._explained.clear()
+        self.app = Flask(__name__)
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE movies (id INTEGER PRIMARY KEY)')
+
+    def setup(self, **config):
+        self.app.config.update(config)
+        load_settings(self.app.config, {})
+        setup_profiler(self.app)
+
+    def request(self, view):
+        with self.app.test_request_context('/movies'):
+            start_timer()
+            profiler.start_profile()
+            response = view()
+            profiler.report(self.app.response_class())
+            return response
+
+    def select_movies(self, times):
+        for movie_id in range(times):
+            self.engine.execute('SELECT id FROM movies WHERE id = ?',
+                                movie_id)
+
+    def test_shape_collapses_in_lists(self):
+        self.assertEqual(
+            shape('SELECT id FROM movies\n WHERE id IN (?, ?, ?)'),
+            shape('SELECT id FROM movies WHERE id IN (?)'))
+        self.assertEqual(
+            shape('DELETE FROM movies WHERE id IN (%(id_1_1)s, %(id_1_2)s)'),
+            'DELETE FROM movies WHERE id IN (...)')
+
+    def test_budget_raises(self):
+        self.setup(QUERY_BUDGETS='raise')
+        view = query_budget(2)(lambda: self.select_movies(3))
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.request(view)
+        self.assertEqual(raised.exception.statements, 3)
+
+    def test_budget_within(self):
+        self.setup(QUERY_BUDGETS='raise')
+        view = query_budget(3)(lambda: self.select_movies(3) or 'ok')
+
+        self.assertEqual(self.request(view), 'ok')
+
+    def test_budget_logs(self):
+        self.setup(QUERY_BUDGETS='log')
+        view = query_budget(0)(lambda: self.select_movies(1))
+
+        with self.assertLogs('database.profiler', 'WARNING') as logs:
+            self.request(view)
+        self.assertIn('budget is 0', logs.output[0])
+
+    def test_repeated_statement_is_flagged(self):
+        self.setup(N_PLUS_ONE_THRESHOLD=5)
+
+        with self.assertLogs('database.profiler', 'WARNING') as logs:
+            self.request(lambda: self.select_movies(6))
+        self.assertIn('ran this statement 6 times', logs.output[0])
+
+    def test_budgets_count_with_the_request_timer(self):
+        # the statements are counted by the timer of metrics.py, which
+        # the profiler starts itself when metrics are off
+        self.app.testing = True
+        self.app.route('/movies')(
+            query_budget(1)(lambda: self.select_movies(2) or 'ok'))
+        self.setup(QUERY_BUDGETS='raise', METRICS='off')
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.app.test_client().get('/movies')
+        self.assertEqual(raised.exception.statements, 2)
+
+    def test_settings_are_per_app(self):
+        self.setup(QUERY_BUDGETS='raise')
+        other = Flask(__name__)
+        load_settings(other.config, {})
+        setup_profiler(other)
+        view = query_budget(0)(lambda: self.select_movies(1) or 'ok')
+
+        with other.test_request_context('/movies'):
+            start_timer()
+            profiler.start_profile()
+            self.assertEqual(view(), 'ok')
+        with self.assertRaises(QueryBudgetExceeded):
+            self.request(view)
+
+        with self.assertRaises(ValueError):
+            self.setup(QUERY_BUDGETS='sometimes')
+
+    def test_slow_statement_is_logged_with_its_plan(self):
+        self.setup(SLOW_QUERY_MS=0)
+
+        with self.app.app_context(), \
+                self.assertLogs('database.profiler', 'WARNING') as logs:
+            self.select_movies(2)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('parameters: (0,)', logs.output[0])
+        self.assertIn('plan:', logs.output[0])
+        # the plan is sampled once per statement shape
+        self.assertNotIn('plan:', logs.output[1])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import unittest
+from datetime import date
+
+from serializer import Serializer, Encoded, orjson, row_dict
+
+
+class SerializerTestCase(unittest.TestCase):
+    """This class represents the JSON serializer test case"""
+
+    fields = ('id', 'title', 'release_date')
+    rows = [(1, 'kingdom', date(2019, 10, 25)),
+            (2, 'say "hi" é', None)]
+
+    def serializers(self):
+        serializers = [Serializer('json')]
+        if orjson is not None:
+            serializers.append(Serializer('orjson'))
+        return serializers
+
+    def test_rows_as_objects(self):
+        for serializer in self.serializers():
+            data = json.loads(serializer.rows(self.fields, self.rows))
+
+            self.assertEqual(data, [
+                {'id': 1, 'title': 'kingdom', 'release_date': '2019-10-25'},
+                {'id': 2, 'title': 'say "hi" é', 'release_date': None}
+            ])
+
+    def test_rows_leave_out_extra_columns(self):
+        for serializer in self.serializers():
+            data = json.loads(serializer.rows(('id',), self.rows))
+
+            self.assertEqual(data, [{'id': 1}, {'id': 2}])
+
+    def test_row_dict(self):
+        to_dict = row_dict(('id', "it's"))
+
+        self.assertEqual(to_dict((1, 'a', 'extra')), {'id': 1, "it's": 'a'})
+        self.assertIs(row_dict(('id', "it's")), to_dict)
+
+    def test_lines(self):
+        for serializer in self.serializers():
+            lines = serializer.lines(self.fields, self.rows).splitlines()
+
+            self.assertEqual([json.loads(line)['id'] for line in lines],
+                             [1, 2])
+
+    def test_payload_copies_encoded_values(self):
+        for serializer in self.serializers():
+            body = serializer.payload({
+                'success': True,
+                'movies': Encoded(b'[{"id":1}]'),
+                'next': None
+            })
+
+            self.assertEqual(json.loads(body), {
+                'success': True, 'movies': [{'id': 1}], 'next': None})
+            self.assertNotIn(b' ', body)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Serializer('yaml')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()